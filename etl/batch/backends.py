@@ -0,0 +1,670 @@
+import os
+import io
+import csv
+import json
+import uuid
+import shutil
+import sqlite3
+import contextlib
+import datetime as dt
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from pyarrow import fs
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
+from utils import deserialize, download_bytes
+
+
+
+
+# Local stand-ins for the cloud services used by the batch scripts, so a pipeline can
+# run end to end on a laptop (`--backend local`). They implement only the parts of the
+# google-cloud-storage, boto3 and gspread APIs that the scripts call. The warehouse is
+# the scripts' own interface instead, with an SQLite file and a BigQuery dataset behind
+# it; a script picks one at startup and only calls `warehouse.*` after that
+
+BACKENDS = ['cloud', 'local']
+
+
+def list_keys(bucket_dir:str, prefix:str='') -> list:
+
+    # Object keys under `prefix` in name order, like GCS/S3 listings. Directories are
+    # listed as folder markers ("<folder>/") since the scripts create and check those
+    start_dir = os.path.join(bucket_dir, os.path.dirname(prefix))
+    keys = [prefix] if prefix.endswith('/') and os.path.isdir(start_dir) else []
+    for root, dirs, files in os.walk(start_dir):
+        rel_root = os.path.relpath(root, bucket_dir).replace(os.sep, '/')
+        rel_root = '' if rel_root == '.' else f'{rel_root}/'
+        keys.extend(f'{rel_root}{name}/' for name in dirs)
+        keys.extend(f'{rel_root}{name}' for name in files)
+    return sorted(key for key in keys if key.startswith(prefix))
+
+
+def write_file(path:str, data:bytes) -> None:
+
+    # Write to a temp file first so readers never see a partial object
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(f'{path}.tmp', path)
+
+
+class LocalBlob:
+    # google.cloud.storage.Blob backed by a file; the generation is the file's mtime
+
+    def __init__(self, bucket, name:str):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.path, name)
+        self.metadata_path = os.path.join(bucket.metadata_dir, f'{name.rstrip("/")}.json')
+        self.metadata = None
+        self.content_type = None
+        self.generation = None
+        self.size = None
+
+    def reload(self) -> None:
+        stat = os.stat(self.path)
+        self.generation = stat.st_mtime_ns
+        self.size = 0 if os.path.isdir(self.path) else stat.st_size
+        if os.path.exists(self.metadata_path):
+            with open(self.metadata_path, 'r') as f:
+                self.metadata = json.load(f)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def upload_from_string(self, data, content_type:str=None) -> None:
+        if self.name.endswith('/'):
+            os.makedirs(self.path, exist_ok=True)
+        else:
+            write_file(self.path, data.encode('utf-8') if isinstance(data, str) else data)
+        if self.metadata is not None:
+            write_file(self.metadata_path, json.dumps(self.metadata).encode('utf-8'))
+        self.content_type = content_type
+        self.reload()
+
+    def upload_from_filename(self, filename:str, content_type:str=None) -> None:
+        with open(filename, 'rb') as f:
+            self.upload_from_string(f.read(), content_type)
+
+    def download_as_bytes(self) -> bytes:
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def delete(self) -> None:
+        if self.name.endswith('/'):
+            with contextlib.suppress(OSError):
+                os.rmdir(self.path)
+        else:
+            os.remove(self.path)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.metadata_path)
+
+
+class LocalBucket:
+    # google.cloud.storage.Bucket backed by a directory
+
+    def __init__(self, root:str, name:str):
+        self.name = name
+        self.path = os.path.join(root, name)
+        self.metadata_dir = os.path.join(root, '.metadata', name)
+
+    def exists(self) -> bool:
+        return os.path.isdir(self.path)
+
+    def blob(self, name:str) -> LocalBlob:
+        return LocalBlob(self, name)
+
+    def get_blob(self, name:str) -> LocalBlob:
+        blob = LocalBlob(self, name)
+        if not blob.exists():
+            return None
+        blob.reload()
+        return blob
+
+    def list_blobs(self, prefix:str=None, start_offset:str=None, end_offset:str=None):
+        for key in list_keys(self.path, prefix or ''):
+            if (start_offset is None or key >= start_offset) and (end_offset is None or key < end_offset):
+                blob = LocalBlob(self, key)
+                blob.reload()
+                yield blob
+
+    def copy_blob(self, blob:LocalBlob, destination_bucket, new_name:str) -> LocalBlob:
+        new_blob = destination_bucket.blob(new_name)
+        new_blob.metadata = blob.metadata
+        new_blob.upload_from_string(blob.download_as_bytes(), blob.content_type)
+        return new_blob
+
+
+class LocalStorageClient:
+    # google.cloud.storage.Client with each bucket as a folder under `root`
+
+    def __init__(self, root:str):
+        self.root = root
+
+    def bucket(self, name:str) -> LocalBucket:
+        return LocalBucket(self.root, name)
+
+    def lookup_bucket(self, name:str) -> LocalBucket:
+        bucket = self.bucket(name)
+        return bucket if bucket.exists() else None
+
+    def get_bucket(self, name:str) -> LocalBucket:
+        bucket = self.lookup_bucket(name)
+        if bucket is None:
+            raise FileNotFoundError(f'bucket {name} does not exist under {self.root}')
+        return bucket
+
+    def create_bucket(self, name:str) -> LocalBucket:
+        bucket = self.bucket(name)
+        os.makedirs(bucket.path, exist_ok=True)
+        return bucket
+
+
+class LocalS3Paginator:
+
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Bucket:str, Prefix:str=''):
+        # everything fits in one page locally
+        yield self.client.list_objects(Bucket=Bucket, Prefix=Prefix)
+
+
+class LocalS3Client:
+    # boto3 S3 client with each bucket as a folder under `root`. Buckets are created
+    # on first write, so head_bucket always succeeds
+
+    def __init__(self, root:str):
+        self.root = root
+
+    def head_bucket(self, Bucket:str) -> dict:
+        return {}
+
+    def create_bucket(self, Bucket:str, **kwargs) -> dict:
+        os.makedirs(os.path.join(self.root, Bucket), exist_ok=True)
+        return {}
+
+    def put_object(self, Bucket:str, Key:str, Body=b'', **kwargs) -> dict:
+        path = os.path.join(self.root, Bucket, Key)
+        if Key.endswith('/'):
+            os.makedirs(path, exist_ok=True)
+        else:
+            write_file(path, Body.encode('utf-8') if isinstance(Body, str) else Body)
+        return {}
+
+    def get_object(self, Bucket:str, Key:str, Range:str=None) -> dict:
+        with open(os.path.join(self.root, Bucket, Key), 'rb') as f:
+            if Range is None:
+                return {'Body': io.BytesIO(f.read())}
+            # "bytes=<first>-<last>", both inclusive
+            first, last = (int(pos) for pos in Range.split('=')[1].split('-'))
+            f.seek(first)
+            return {'Body': io.BytesIO(f.read(last - first + 1))}
+
+    def list_objects(self, Bucket:str, Prefix:str='') -> dict:
+        bucket_dir = os.path.join(self.root, Bucket)
+        contents = [
+            {'Key': key, 'Size': 0 if key.endswith('/') else os.path.getsize(os.path.join(bucket_dir, key))}
+            for key in list_keys(bucket_dir, Prefix)
+        ]
+        return {'Contents': contents} if contents else {}
+
+    def get_paginator(self, operation_name:str) -> LocalS3Paginator:
+        return LocalS3Paginator(self)
+
+    def download_file(self, Bucket:str, Key:str, Filename:str) -> None:
+        shutil.copyfile(os.path.join(self.root, Bucket, Key), Filename)
+
+
+def local_s3_filesystem(root:str) -> fs.FileSystem:
+
+    # Same `<bucket>/<key>` paths as pyarrow's S3FileSystem
+    return fs.SubTreeFileSystem(os.path.abspath(root), fs.LocalFileSystem())
+
+
+class LocalWorksheet:
+    # gspread Worksheet read from a CSV export of the sheet
+
+    def __init__(self, path:str):
+        self.path = path
+
+    def get_all_values(self) -> list:
+        df = pd.read_csv(self.path, dtype=str, keep_default_na=False)
+        return [df.columns.tolist()] + df.values.tolist()
+
+    def get_all_records(self) -> list:
+        # empty cells stay empty strings, like gspread
+        return pd.read_csv(self.path, keep_default_na=False).to_dict('records')
+
+
+def to_sqlite_value(value):
+
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    if value is None or (not isinstance(value, (list, dict)) and pd.isna(value)):
+        return None
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat(sep=' ')
+    return value
+
+
+def to_sqlite_type(dtype) -> str:
+
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'REAL'
+    return 'TEXT'
+
+
+# SQLite column types of the BigQuery types used in the schema files
+SQLITE_FIELD_TYPES = {'INTEGER': 'INTEGER', 'BOOLEAN': 'INTEGER', 'FLOAT': 'REAL'}
+
+
+class SQLiteWarehouse:
+    # Stand-in for the BigQuery dataset. Writes that have to be atomic together run
+    # inside `with warehouse.transaction():`
+
+    def __init__(self, path:str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, isolation_level=None)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        if self.conn.in_transaction:
+            yield
+            return
+
+        self.conn.execute('BEGIN')
+        try:
+            yield
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+    def quote(self, table:str) -> str:
+        # the table as it's written in query()
+        return f'"{table}"'
+
+    def table_exists(self, table:str) -> bool:
+        query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+        return self.conn.execute(query, (table,)).fetchone() is not None
+
+    def ensure_table(self, table:str, schema:list=None) -> None:
+
+        # `schema` is a list of {"name", "type", "mode"} fields, like the schema files.
+        # Without one the table is created by the first write
+        if schema:
+            columns = ', '.join(f'"{field["name"]}" {SQLITE_FIELD_TYPES.get(field["type"], "TEXT")}' for field in schema)
+            self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ({columns})')
+
+    def query(self, sql:str) -> pd.DataFrame:
+        return pd.read_sql_query(sql, self.conn)
+
+    def distinct_dates(self, table:str, column:str) -> list:
+        if not self.table_exists(table):
+            return []
+        return self.query(f'SELECT DISTINCT substr("{column}", 1, 10) AS day FROM "{table}"')['day'].dropna().tolist()
+
+    def missing_ids(self, table:str, key:str, ids:list, where:str=None) -> list:
+
+        # Keys in the table (matching `where`) that aren't in `ids`
+        if not self.table_exists(table):
+            return []
+        condition = f'"{key}" NOT IN ({self._stage_keys(key, ids)})' + (f' AND {where}' if where else '')
+        return self.query(f'SELECT "{key}" FROM "{table}" WHERE {condition}')[key].tolist()
+
+    def _ensure_table(self, table:str, df:pd.DataFrame, temporary:bool=False) -> None:
+
+        # New columns are added as they show up, like ALLOW_FIELD_ADDITION in BigQuery
+        columns = ', '.join(f'"{col}" {to_sqlite_type(dtype)}' for col, dtype in df.dtypes.items())
+        self.conn.execute(f'CREATE {"TEMP " if temporary else ""}TABLE IF NOT EXISTS "{table}" ({columns})')
+        existing = set(row[1] for row in self.conn.execute(f'PRAGMA table_info("{table}")'))
+        for col, dtype in df.dtypes.items():
+            if col not in existing:
+                self.conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{col}" {to_sqlite_type(dtype)}')
+
+    def _insert(self, table:str, df:pd.DataFrame) -> None:
+
+        columns = ', '.join(f'"{col}"' for col in df.columns)
+        placeholders = ', '.join('?' for _ in df.columns)
+        rows = ([to_sqlite_value(value) for value in row] for row in df.astype(object).itertuples(index=False, name=None))
+        self.conn.executemany(f'INSERT INTO "{table}" ({columns}) VALUES ({placeholders})', rows)
+
+    def _stage_keys(self, key:str, ids:list) -> str:
+
+        # Key lists go through a temp table, since SQLite limits the number of query parameters
+        self.conn.execute('DROP TABLE IF EXISTS temp."_keys"')
+        self.conn.execute(f'CREATE TEMP TABLE "_keys" ("{key}")')
+        self.conn.executemany('INSERT INTO temp."_keys" VALUES (?)', ((to_sqlite_value(id),) for id in ids))
+        return f'SELECT "{key}" FROM temp."_keys"'
+
+    def append(self, table:str, df:pd.DataFrame) -> int:
+        with self.transaction():
+            self._ensure_table(table, df)
+            self._insert(table, df)
+        return df.shape[0]
+
+    def append_blob(self, table:str, blob, file_format:str) -> int:
+        return self.append(table, deserialize(download_bytes(blob), file_format))
+
+    def replace(self, table:str, file, file_format:str, field_types:dict=None, batch_size:int=50000) -> int:
+
+        # Replaces the table with the rows of a local file object. SQLite columns take any
+        # value, so the `field_types` of CSV files are only needed by BigQuery. The file is
+        # staged first, then the staging table is swapped in atomically
+        if file_format == 'parquet':
+            dfs = (batch.to_pandas() for batch in pq.ParquetFile(file).iter_batches(batch_size=batch_size))
+        else:
+            dfs = pd.read_csv(file, chunksize=batch_size)
+
+        staging = f'{table}__staging'
+        self.conn.execute(f'DROP TABLE IF EXISTS "{staging}"')
+        num_rows = sum(self.append(staging, df) for df in dfs)
+        with self.transaction():
+            self.conn.execute(f'DROP TABLE IF EXISTS "{table}"')
+            self.conn.execute(f'ALTER TABLE "{staging}" RENAME TO "{table}"')
+        return num_rows
+
+    def merge(self, table:str, df:pd.DataFrame, key:str, compare_columns:list=None) -> int:
+
+        # Upsert on `key`. With `compare_columns`, rows whose values are unchanged are left
+        # untouched, like the fingerprint-gated MERGE in BigQuery. Returns the rows written
+        with self.transaction():
+            self._ensure_table(table, df)
+            self.conn.execute('DROP TABLE IF EXISTS temp."_merge"')
+            self._ensure_table('_merge', df, temporary=True)
+            self._insert('_merge', df)
+
+            if compare_columns:
+                unchanged = ' AND '.join(f'target."{col}" IS temp."_merge"."{col}"' for col in compare_columns)
+                self.conn.execute(f'''
+                    DELETE FROM temp."_merge"
+                    WHERE EXISTS (
+                        SELECT 1 FROM "{table}" AS target
+                        WHERE target."{key}" = temp."_merge"."{key}" AND {unchanged}
+                    )
+                ''')
+
+            columns = ', '.join(f'"{col}"' for col in df.columns)
+            self.conn.execute(f'DELETE FROM "{table}" WHERE "{key}" IN (SELECT "{key}" FROM temp."_merge")')
+            num_rows = self.conn.execute(f'INSERT INTO "{table}" ({columns}) SELECT {columns} FROM temp."_merge"').rowcount
+            self.conn.execute('DROP TABLE temp."_merge"')
+        return num_rows
+
+    def update(self, table:str, values:dict, key:str, ids:list, where:str=None) -> int:
+
+        with self.transaction():
+            assignments = ', '.join(f'"{col}" = ?' for col in values)
+            condition = f'"{key}" IN ({self._stage_keys(key, ids)})' + (f' AND {where}' if where else '')
+            params = [to_sqlite_value(value) for value in values.values()]
+            return self.conn.execute(f'UPDATE "{table}" SET {assignments} WHERE {condition}', params).rowcount
+
+    def delete(self, table:str, key:str=None, ids:list=None) -> int:
+
+        # Without ids, every row is deleted
+        with self.transaction():
+            if key is None:
+                return self.conn.execute(f'DELETE FROM "{table}"').rowcount
+            return self.conn.execute(f'DELETE FROM "{table}" WHERE "{key}" IN ({self._stage_keys(key, ids)})').rowcount
+
+
+class BigQueryWarehouse:
+    # The same interface on a BigQuery dataset. Statements run inside
+    # `with warehouse.transaction():` share a session and commit together; load, copy
+    # and table jobs aren't transactional and run outside of it
+
+    def __init__(self, client:bigquery.Client, project_id:str, dataset:str):
+        self.client = client
+        self.project_id = project_id
+        self.dataset = dataset
+        self.in_transaction = False
+        self.session_id = None
+
+    def table_ref(self, table:str) -> str:
+        return f'{self.project_id}.{self.dataset}.{table}'
+
+    def quote(self, table:str) -> str:
+        # the table as it's written in query()
+        return f'`{self.table_ref(table)}`'
+
+    def _run(self, sql:str, params:list=None) -> bigquery.QueryJob:
+
+        # The transaction only begins with its first statement, so the staging tables and
+        # schema changes that e.g. merge() makes before its MERGE are visible to it
+        if self.in_transaction and self.session_id is None:
+            job = self.client.query('BEGIN TRANSACTION', job_config=bigquery.QueryJobConfig(create_session=True))
+            job.result()
+            self.session_id = job.session_info.session_id
+
+        job_config = bigquery.QueryJobConfig(query_parameters=params or [])
+        if self.session_id is not None:
+            job_config.connection_properties = [bigquery.ConnectionProperty('session_id', self.session_id)]
+        job = self.client.query(sql, job_config=job_config)
+        job.result()
+        return job
+
+    @contextlib.contextmanager
+    def transaction(self):
+        if self.in_transaction:
+            yield
+            return
+
+        self.in_transaction = True
+        try:
+            yield
+        except BaseException:
+            # a failed statement has already rolled the transaction back
+            if self.session_id is not None:
+                with contextlib.suppress(Exception):
+                    self._run('ROLLBACK TRANSACTION')
+            raise
+        else:
+            if self.session_id is not None:
+                self._run('COMMIT TRANSACTION')
+        finally:
+            if self.session_id is not None:
+                with contextlib.suppress(Exception):
+                    self._run('CALL BQ.ABORT_SESSION()')
+            self.in_transaction = False
+            self.session_id = None
+
+    def table_exists(self, table:str) -> bool:
+        try:
+            self.client.get_table(self.table_ref(table))
+        except NotFound:
+            return False
+        return True
+
+    def ensure_table(self, table:str, schema:list=None) -> bigquery.Table:
+        self.client.create_dataset(bigquery.Dataset(f'{self.project_id}.{self.dataset}'), exists_ok=True)
+        fields = [bigquery.SchemaField.from_api_repr(field) for field in schema or []]
+        return self.client.create_table(bigquery.Table(self.table_ref(table), schema=fields), exists_ok=True)
+
+    def query(self, sql:str) -> pd.DataFrame:
+        rows = self._run(sql).result()
+        return pd.DataFrame([dict(row.items()) for row in rows], columns=[field.name for field in rows.schema])
+
+    def distinct_dates(self, table:str, column:str) -> list:
+        if not self.table_exists(table):
+            return []
+        days = self.query(f'SELECT DISTINCT DATE(`{column}`) AS day FROM {self.quote(table)}')['day'].dropna()
+        return [day.strftime('%Y-%m-%d') for day in days]
+
+    def _create_work_table(self, name:str, schema:list) -> str:
+
+        # Tables that only live for one call; they expire on their own in case the
+        # process dies before it gets to delete them
+        work_table = bigquery.Table(self.table_ref(f'{name}_{uuid.uuid4().hex}'), schema=schema)
+        work_table.expires = dt.datetime.now(dt.timezone.utc) + dt.timedelta(hours=1)
+        return self.client.create_table(work_table).full_table_id.replace(':', '.')
+
+    def _load_dataframe(self, df:pd.DataFrame, table_ref:str, fields:list) -> bigquery.LoadJob:
+
+        # Tables first created through a CSV round-trip store e.g. timestamps as STRING,
+        # so cast those columns to match instead of letting the load job fail
+        df = df.copy()
+        for field in fields:
+            if field.field_type == 'STRING' and field.name in df.columns and not pd.api.types.is_string_dtype(df[field.name]):
+                df[field.name] = df[field.name].astype('string')
+
+        # Optional fields (e.g. openweather's rain.1h) only show up in some batches: new ones
+        # are added to the table, and table fields missing from this batch are left out of the
+        # schema since the client rejects schema fields that aren't in the DataFrame
+        job_config = bigquery.LoadJobConfig(
+            schema=[field for field in fields if field.name in df.columns] or None,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION]
+        )
+        job = self.client.load_table_from_dataframe(df, table_ref, job_config=job_config)
+        job.result()
+        return job
+
+    def append(self, table:str, df:pd.DataFrame) -> int:
+        bq_table = self.ensure_table(table)
+        return self._load_dataframe(df, self.table_ref(table), bq_table.schema).output_rows
+
+    def append_blob(self, table:str, blob, file_format:str) -> int:
+
+        # Parquet files are loaded by BigQuery directly from the bucket
+        if file_format != 'parquet':
+            return self.append(table, deserialize(download_bytes(blob), file_format))
+
+        self.ensure_table(table)
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION]
+        )
+        job = self.client.load_table_from_uri(f'gs://{blob.bucket.name}/{blob.name}', self.table_ref(table), job_config=job_config)
+        job.result()
+        return job.output_rows
+
+    def replace(self, table:str, file, file_format:str, field_types:dict=None, batch_size:int=None) -> int:
+
+        # Loads the local file object into a staging table, then swaps it in; the copy job
+        # replaces the target atomically. CSV columns keep their type in the current table
+        # so the swap doesn't change its schema, and new ones get their `field_types`
+        self.client.create_dataset(bigquery.Dataset(f'{self.project_id}.{self.dataset}'), exists_ok=True)
+        staging_ref = self.table_ref(f'{table}__staging')
+        if file_format == 'parquet':
+            job_config = bigquery.LoadJobConfig(
+                source_format=bigquery.SourceFormat.PARQUET,
+                write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE
+            )
+        else:
+            columns = next(csv.reader([file.readline().decode('utf-8')]))
+            file.seek(0)
+            try:
+                current_fields = {field.name: field for field in self.client.get_table(self.table_ref(table)).schema}
+            except NotFound:
+                current_fields = {}
+            job_config = bigquery.LoadJobConfig(
+                source_format=bigquery.SourceFormat.CSV,
+                skip_leading_rows=1,
+                schema=[current_fields.get(col) or bigquery.SchemaField(col, field_types[col]) for col in columns],
+                write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE
+            )
+        job = self.client.load_table_from_file(file, staging_ref, job_config=job_config)
+        job.result()
+
+        copy_config = bigquery.CopyJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+        self.client.copy_table(staging_ref, self.table_ref(table), job_config=copy_config).result()
+        self.client.delete_table(staging_ref)
+        return job.output_rows
+
+    def merge(self, table:str, df:pd.DataFrame, key:str, compare_columns:list=None) -> int:
+
+        # Upsert on `key` through a staging table. With `compare_columns`, a FARM_FINGERPRINT
+        # of those columns is kept in `_fingerprint` and matched rows are only rewritten when
+        # it changed. Returns the rows written
+        if not self.table_exists(table):
+            return self.append(table, df)
+
+        target = self.client.get_table(self.table_ref(table))
+        fields = [field for field in target.schema if field.name in df.columns]
+        staging_ref = self._create_work_table(f'{table}__merge', fields)
+        try:
+            self._load_dataframe(df, staging_ref, fields)
+
+            # New columns (and the fingerprint) are added to the target before the MERGE
+            target_columns = set(field.name for field in target.schema)
+            new_fields = [field for field in self.client.get_table(staging_ref).schema if field.name not in target_columns]
+            if compare_columns and '_fingerprint' not in target_columns:
+                new_fields.append(bigquery.SchemaField('_fingerprint', 'INTEGER'))
+            if new_fields:
+                target.schema = list(target.schema) + new_fields
+                self.client.update_table(target, ['schema'])
+
+            columns = list(df.columns)
+            fingerprint = changed = ''
+            if compare_columns:
+                columns.append('_fingerprint')
+                fingerprint = f", FARM_FINGERPRINT(TO_JSON_STRING(STRUCT({', '.join(f'staging.`{col}`' for col in compare_columns)}))) AS _fingerprint"
+                changed = ' AND target._fingerprint IS DISTINCT FROM source._fingerprint'
+            sql = f"""
+                MERGE INTO {self.quote(table)} AS target
+                USING (
+                    SELECT *{fingerprint}
+                    FROM `{staging_ref}` AS staging
+                ) AS source
+                ON target.`{key}` = source.`{key}`
+                WHEN MATCHED{changed} THEN
+                UPDATE SET {', '.join(f'target.`{col}` = source.`{col}`' for col in columns)}
+                WHEN NOT MATCHED THEN
+                INSERT ({', '.join(f'`{col}`' for col in columns)})
+                VALUES ({', '.join(f'source.`{col}`' for col in columns)})
+                """
+            return self._run(sql).num_dml_affected_rows
+        finally:
+            self.client.delete_table(staging_ref, not_found_ok=True)
+
+    def _key_param(self, table:str, key:str, ids:list) -> bigquery.ArrayQueryParameter:
+        field_types = {field.name: field.field_type for field in self.client.get_table(self.table_ref(table)).schema}
+        return bigquery.ArrayQueryParameter('ids', field_types[key], list(ids))
+
+    def update(self, table:str, values:dict, key:str, ids:list, where:str=None) -> int:
+
+        # Rows changed outside of merge() lose their fingerprint, so the next merge rewrites them
+        target = self.client.get_table(self.table_ref(table))
+        field_types = {field.name: field.field_type for field in target.schema}
+        assignments = [f'`{col}` = @value_{i}' for i, col in enumerate(values)]
+        if '_fingerprint' in field_types:
+            assignments.append('`_fingerprint` = NULL')
+        params = [bigquery.ScalarQueryParameter(f'value_{i}', field_types[col], value) for i, (col, value) in enumerate(values.items())]
+        params.append(self._key_param(table, key, ids))
+        condition = f'`{key}` IN UNNEST(@ids)' + (f' AND {where}' if where else '')
+        return self._run(f'UPDATE {self.quote(table)} SET {", ".join(assignments)} WHERE {condition}', params).num_dml_affected_rows
+
+    def delete(self, table:str, key:str=None, ids:list=None) -> int:
+
+        # Without ids, every row is deleted
+        if key is None:
+            return self._run(f'DELETE FROM {self.quote(table)} WHERE TRUE').num_dml_affected_rows
+        return self._run(f'DELETE FROM {self.quote(table)} WHERE `{key}` IN UNNEST(@ids)', [self._key_param(table, key, ids)]).num_dml_affected_rows
+
+    def missing_ids(self, table:str, key:str, ids:list, where:str=None) -> list:
+
+        # Keys in the table (matching `where`) that aren't in `ids`. The ids are uploaded and
+        # anti-joined in BigQuery, so only the missing keys come back
+        if not self.table_exists(table):
+            return []
+        ids_fields = [bigquery.SchemaField(key, 'STRING', mode='REQUIRED')]
+        ids_ref = self._create_work_table(f'{table}__ids', ids_fields)
+        try:
+            self._load_dataframe(pd.DataFrame({key: [str(id) for id in ids]}), ids_ref, ids_fields)
+            sql = f"""
+                SELECT target.`{key}`
+                FROM {self.quote(table)} AS target
+                LEFT JOIN `{ids_ref}` AS ids
+                ON CAST(target.`{key}` AS STRING) = ids.`{key}`
+                WHERE {f'({where}) AND ' if where else ''}ids.`{key}` IS NULL
+                """
+            return self.query(sql)[key].tolist()
+        finally:
+            self.client.delete_table(ids_ref, not_found_ok=True)
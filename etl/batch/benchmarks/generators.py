@@ -0,0 +1,185 @@
+import time
+import numpy as np
+import pandas as pd
+
+
+
+
+# Synthetic API payloads shaped like each source's responses, seeded so every run
+# benchmarks the same data
+
+
+def make_usgs_features(n:int) -> list:
+
+    # Features of the USGS GeoJSON summary feed
+    rng = np.random.default_rng(0)
+    now_ms = int(time.time() * 1000)
+    features = []
+    for i in range(n):
+        features.append({
+            'type': 'Feature',
+            'properties': {
+                'mag': round(float(rng.uniform(-1, 8)), 2),
+                'place': f'{i} km N of Somewhere',
+                'time': now_ms - int(rng.integers(0, 86400000)),
+                'updated': now_ms,
+                'tz': None,
+                'url': f'https://earthquake.usgs.gov/earthquakes/eventpage/us{i}',
+                'detail': f'https://earthquake.usgs.gov/fdsnws/event/1/query?eventid=us{i}&format=geojson',
+                'felt': None,
+                'cdi': None,
+                'mmi': None,
+                'alert': None,
+                'status': 'automatic',
+                'tsunami': 0,
+                'sig': int(rng.integers(0, 1000)),
+                'net': 'us',
+                'code': str(i),
+                'ids': f',us{i},',
+                'sources': ',us,',
+                'types': ',origin,phase-data,',
+                'nst': None,
+                'dmin': None,
+                'rms': round(float(rng.uniform(0, 1)), 2),
+                'gap': None,
+                'magType': 'ml',
+                'type': 'earthquake',
+                'title': f'M 1.0 - {i} km N of Somewhere'
+            },
+            'geometry': {
+                'type': 'Point',
+                'coordinates': [
+                    round(float(rng.uniform(-180, 180)), 4),
+                    round(float(rng.uniform(-90, 90)), 4),
+                    round(float(rng.uniform(0, 700)), 2)
+                ]
+            },
+            'id': f'us{i}'
+        })
+    return features
+
+
+def make_published_at(n:int, offsets:list) -> pd.Series:
+
+    # ISO 8601 strings over the past year with the given UTC offsets ('' for naive)
+    rng = np.random.default_rng(0)
+    start = pd.Timestamp('2023-06-01')
+    seconds = rng.integers(0, 365 * 86400, n)
+    offset = rng.choice(offsets, n)
+    return pd.Series([
+        f'{(start + pd.Timedelta(seconds=int(s))).isoformat()}{o}'
+        for s, o in zip(seconds, offset)
+    ])
+
+
+def make_mediastack_articles(n:int) -> list:
+
+    # `data` items of the mediastack /v1/news endpoint
+    rng = np.random.default_rng(0)
+    categories = ['general', 'business', 'entertainment', 'health', 'science', 'sports', 'technology']
+    sources = ['inquirer', 'philstar', 'rappler', 'gmanetwork', 'abs-cbn']
+    published_at = make_published_at(n, ['+00:00', '+08:00'])
+    return [
+        {
+            'author': None if i % 3 else f'Author {i % 97}',
+            'title': f'Headline number {i}',
+            'description': f'Summary of article {i}. ' * int(rng.integers(1, 6)),
+            'url': f'https://news.example.ph/{i}',
+            'source': sources[i % len(sources)],
+            'image': None if i % 4 else f'https://news.example.ph/{i}.jpg',
+            'category': categories[int(rng.integers(0, len(categories)))],
+            'language': 'en',
+            'country': 'ph',
+            'published_at': published_at[i]
+        }
+        for i in range(n)
+    ]
+
+
+def make_fhv_rows(n:int) -> list:
+
+    # Rows of the SODA FHV trip records; SODA returns every value as a string
+    rng = np.random.default_rng(0)
+    start = np.datetime64('2019-01-01T00:00:00')
+    pickup = start + rng.integers(0, 31 * 86400, n).astype('timedelta64[s]')
+    dropoff = pickup + rng.integers(60, 7200, n).astype('timedelta64[s]')
+    bases = [f'B{i:05d}' for i in range(200)]
+    return [
+        {
+            'dispatching_base_num': bases[i % len(bases)],
+            'pickup_datetime': f'{pickup[i]}.000',
+            'dropoff_datetime': f'{dropoff[i]}.000',
+            'pulocationid': str(int(rng.integers(1, 266))),
+            'dolocationid': str(int(rng.integers(1, 266))),
+            'sr_flag': None,
+            'affiliated_base_number': bases[(i + 1) % len(bases)]
+        }
+        for i in range(n)
+    ]
+
+
+def make_finance_sheet(n:int) -> list:
+
+    # Raw values of the ledger sheet (header row first), as returned by get_all_values();
+    # gspread returns every cell as a string and empty cells as ''
+    rng = np.random.default_rng(0)
+    start = pd.Timestamp('2023-01-01')
+    types = ['food', 'transportation', 'utilities', 'shopping', 'income']
+    sources = ['cash', 'gcash', 'credit card', 'debit card']
+    rows = [['id', 'year', 'month', 'day', 'item', 'type', 'cost', 'to', 'store', 'source', 'created_at', 'updated_at']]
+    for i in range(n):
+        date = start + pd.Timedelta(days=int(rng.integers(0, 365)))
+        created_at = date + pd.Timedelta(seconds=int(rng.integers(0, 86400)))
+        updated_at = created_at + pd.Timedelta(seconds=int(rng.integers(0, 86400))) if i % 10 == 0 else created_at
+        rows.append([
+            str(i + 1),
+            str(date.year),
+            str(date.month),
+            str(date.day),
+            '' if i % 20 == 0 else f'item {i % 500}',
+            types[i % len(types)],
+            f'{rng.uniform(1, 5000):.2f}',
+            '' if i % 4 else f'person {i % 30}',
+            f'store {i % 50}',
+            sources[i % len(sources)],
+            created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            updated_at.strftime('%Y-%m-%d %H:%M:%S')
+        ])
+    return rows
+
+
+def make_openweather_responses(n:int) -> list:
+
+    # Responses of the /data/2.5/weather endpoint, one per location
+    rng = np.random.default_rng(0)
+    now = int(time.time())
+    responses = []
+    for i in range(n):
+        response = {
+            'coord': {'lon': round(float(rng.uniform(-180, 180)), 4), 'lat': round(float(rng.uniform(-90, 90)), 4)},
+            'weather': [{'id': 500, 'main': 'Rain', 'description': 'light rain', 'icon': '10d'}],
+            'base': 'stations',
+            'main': {
+                'temp': round(float(rng.uniform(250, 320)), 2),
+                'feels_like': round(float(rng.uniform(250, 320)), 2),
+                'temp_min': round(float(rng.uniform(250, 320)), 2),
+                'temp_max': round(float(rng.uniform(250, 320)), 2),
+                'pressure': int(rng.integers(980, 1040)),
+                'humidity': int(rng.integers(10, 100))
+            },
+            'visibility': 10000,
+            'wind': {'speed': round(float(rng.uniform(0, 20)), 2), 'deg': int(rng.integers(0, 360))},
+            'clouds': {'all': int(rng.integers(0, 100))},
+            'dt': now - int(rng.integers(0, 3600)),
+            'sys': {'country': 'PH', 'sunrise': now - 21600, 'sunset': now + 21600},
+            'timezone': 28800,
+            'id': i,
+            'name': f'Location {i}',
+            'cod': 200,
+            'location': f'location_{i}'
+        }
+        # rain only shows up while it's raining
+        if i % 3 == 0:
+            response['rain'] = {'1h': round(float(rng.uniform(0, 10)), 2)}
+        responses.append(response)
+    return responses
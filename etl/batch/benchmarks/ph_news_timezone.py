@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+import argparse
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from transforms import convert_timezone, normalize_timezone
+from generators import make_published_at
+
+
+
+
+# Parse command line arguments
+parser = argparse.ArgumentParser(prog='PH News timezone normalization benchmark')
+parser.add_argument('--rows', type=int, default=100000, help='number of synthetic published_at values')
+parser.add_argument('--repeat', type=int, default=3, help='runs per implementation; the best run is reported')
+args = parser.parse_args()
+
+
+def legacy_uniform(published_at:pd.Series) -> pd.Series:
+
+    # The transform before vectorization; only works when all offsets are the same
+    published_at = pd.to_datetime(published_at, errors='coerce')
+    return published_at.apply(lambda x: convert_timezone(x, 'Asia/Manila'))
+
+
+def legacy_mixed(published_at:pd.Series) -> pd.Series:
+
+    # Mixed offsets were parsed to an object column of Timestamps by older pandas
+    # (newer versions raise instead), so parse per row before converting
+    published_at = published_at.map(pd.Timestamp)
+    return published_at.apply(lambda x: convert_timezone(x, 'Asia/Manila'))
+
+
+def vectorized(published_at:pd.Series) -> pd.Series:
+
+    return normalize_timezone(published_at, 'Asia/Manila')
+
+
+def best_time(fn, data) -> float:
+
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        fn(data)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+uniform = make_published_at(args.rows, ['+00:00'])
+mixed = make_published_at(args.rows, ['+00:00', '+08:00', '-05:00', ''])
+
+# both paths must agree before timing them
+assert (legacy_mixed(mixed).astype('datetime64[ns, Asia/Manila]') == vectorized(mixed).astype('datetime64[ns, Asia/Manila]')).all()
+
+results = {
+    'legacy convert_timezone (uniform offsets)': (legacy_uniform, uniform),
+    'vectorized (uniform offsets)': (vectorized, uniform),
+    'legacy convert_timezone (mixed offsets)': (legacy_mixed, mixed),
+    'vectorized (mixed offsets)': (vectorized, mixed)
+}
+results = {name: best_time(fn, data) for name, (fn, data) in results.items()}
+
+print(f'[INFO] PH News timezone normalization, {args.rows} rows, best of {args.repeat}:')
+for name, seconds in results.items():
+    baseline = results[name.replace('vectorized', 'legacy convert_timezone')]
+    print(f'[INFO]   {name:<45} {seconds * 1000:10.1f} ms  ({baseline / seconds:7.1f}x)')
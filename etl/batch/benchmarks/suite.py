@@ -0,0 +1,144 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import pandas as pd
+from gspread.utils import numericise_all
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import FILE_FORMATS, serialize, deserialize
+from transforms import diff_snapshot, transform_usgs_earthquake, transform_ph_news, transform_openweather
+from generators import make_usgs_features, make_mediastack_articles, make_fhv_rows, make_finance_sheet, make_openweather_responses
+
+
+
+
+def parse_finance_sheet(values:list) -> pd.DataFrame:
+
+    # The --snapshot_diff extract on its first run, when there's no previous snapshot
+    # and every row is parsed
+    return diff_snapshot(values, {}, numericise_all)[0]
+
+
+# How each pipeline turns an API payload into its raw DataFrame, and its transform (if any);
+# nyc_opendata_fhv's transform_batch is currently a pass-through, so only its I/O is measured
+SOURCES = {
+    'usgs_earthquake': (make_usgs_features, pd.json_normalize, transform_usgs_earthquake),
+    'ph_news': (make_mediastack_articles, pd.json_normalize, lambda df: transform_ph_news(df, '2000-01-01')),
+    'nyc_opendata_fhv': (make_fhv_rows, pd.json_normalize, None),
+    'finance': (make_finance_sheet, parse_finance_sheet, None),
+    'openweather': (make_openweather_responses, pd.json_normalize, transform_openweather)
+}
+budgets_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'budgets.json')
+
+# Parse command line arguments
+parser = argparse.ArgumentParser(prog='ETL benchmark suite')
+parser.add_argument('--sources', nargs='+', default=list(SOURCES), choices=list(SOURCES), help='pipelines to benchmark')
+parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000, 100000], help='numbers of synthetic rows')
+parser.add_argument('--repeat', type=int, default=3, help='timed runs per case; the best run is reported')
+parser.add_argument('--budgets', default=budgets_file, help='JSON file of per-case budgets')
+parser.add_argument('--update_budgets', action='store_true', help='write the measured results (times --headroom) as the new budgets instead of checking them')
+parser.add_argument('--headroom', type=float, default=3.0, help='budget multiplier over the measured results when updating the budgets')
+parser.add_argument('--output', help='also write the results to this JSON file')
+args = parser.parse_args()
+
+
+def measure(fn, make_input) -> tuple:
+
+    # Returns the best wall time and the peak traced memory of fn(make_input()). Inputs are
+    # built outside the measurement since transforms modify their DataFrame in place. Peak
+    # memory comes from a separate run since tracing slows everything down; it covers Python
+    # and numpy allocations but not pyarrow's own memory pool
+    timings = []
+    for _ in range(args.repeat):
+        data = make_input()
+        start = time.perf_counter()
+        fn(data)
+        timings.append(time.perf_counter() - start)
+
+    data = make_input()
+    tracemalloc.start()
+    fn(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return min(timings), peak
+
+
+def run_source(source:str, rows:int) -> dict:
+
+    generate, parse, transform = SOURCES[source]
+    payload = generate(rows)
+
+    results = {}
+    results['parse'] = measure(parse, lambda: payload)
+    df = parse(payload)
+    if transform is not None:
+        results['transform'] = measure(transform, df.copy)
+        df = transform(df.copy())
+
+    for file_format in FILE_FORMATS:
+        results[f'serialize_{file_format}'] = measure(lambda df: serialize(df, file_format), lambda: df)
+        data = serialize(df, file_format)
+        results[f'deserialize_{file_format}'] = measure(lambda data: deserialize(data, file_format), lambda: data)
+
+    return {
+        f'{source}/{case}@{rows}': {'rows': rows, 'seconds': seconds, 'rows_per_second': rows / seconds, 'peak_mb': peak / 1024 ** 2}
+        for case, (seconds, peak) in results.items()
+    }
+
+
+budgets:dict = {}
+if os.path.exists(args.budgets):
+    with open(args.budgets, 'r') as f:
+        budgets = json.load(f)
+
+results = {}
+failures = []
+print(f'[INFO] ETL benchmark suite, best of {args.repeat}:')
+for source in args.sources:
+    for rows in args.scales:
+        for name, result in run_source(source, rows).items():
+            results[name] = result
+
+            # Wall-time budgets only hold on comparable hardware; regenerate them with
+            # --update_budgets when the machine running the suite changes
+            budget = budgets.get(name)
+            over_budget = []
+            if budget is not None and not args.update_budgets:
+                if result['seconds'] > budget['max_seconds']:
+                    over_budget.append(f'{result["seconds"] * 1000:.1f} ms > {budget["max_seconds"] * 1000:.1f} ms')
+                if result['peak_mb'] > budget['max_peak_mb']:
+                    over_budget.append(f'{result["peak_mb"]:.1f} MB > {budget["max_peak_mb"]:.1f} MB')
+            if over_budget:
+                failures.append(name)
+
+            print(
+                f'[INFO]   {name:<45} {result["seconds"] * 1000:10.1f} ms {result["rows_per_second"]:12,.0f} rows/s '
+                f'{result["peak_mb"]:8.1f} MB peak' + (f'  OVER BUDGET ({", ".join(over_budget)})' if over_budget else '')
+            )
+
+if args.output is not None:
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4)
+
+if args.update_budgets:
+    budgets.update({
+        name: {
+            'max_seconds': round(max(result['seconds'], 0.01) * args.headroom, 4),
+            'max_peak_mb': round(max(result['peak_mb'], 1) * args.headroom, 1)
+        }
+        for name, result in results.items()
+    })
+    with open(args.budgets, 'w') as f:
+        json.dump(dict(sorted(budgets.items())), f, indent=4)
+    print(f'[INFO] Updated {len(results)} budgets in {args.budgets}.')
+    exit(0)
+
+if failures:
+    print(f'[ERROR] {len(failures)} cases exceeded their budget: {failures}')
+    exit(1)
+
+print('[INFO] All cases within budget.')
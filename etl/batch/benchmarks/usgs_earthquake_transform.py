@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+import argparse
+import pandas as pd
+from io import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from transforms import split_coordinates, transform_usgs_earthquake
+from generators import make_usgs_features
+
+
+
+
+# Parse command line arguments
+parser = argparse.ArgumentParser(prog='USGS Earthquake transform benchmark')
+parser.add_argument('--rows', type=int, default=20000, help='number of synthetic events')
+parser.add_argument('--repeat', type=int, default=3, help='runs per implementation; the best run is reported')
+args = parser.parse_args()
+
+
+def legacy_split_coordinates(coordinates:pd.Series) -> pd.DataFrame:
+
+    # Per-row split as done before the vectorized transform, kept for comparison
+    return coordinates.apply(lambda x: pd.Series(eval(x)))
+
+
+def best_time(fn, data) -> float:
+
+    timings = []
+    for _ in range(args.repeat):
+        data_copy = data.copy()
+        start = time.perf_counter()
+        fn(data_copy)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+raw_df = pd.json_normalize(make_usgs_features(args.rows))
+csv_df = pd.read_csv(StringIO(raw_df.to_csv(index=False)))
+
+results = {
+    'coordinates, legacy eval (CSV input)': best_time(legacy_split_coordinates, csv_df['geometry.coordinates']),
+    'coordinates, vectorized (CSV input)': best_time(split_coordinates, csv_df['geometry.coordinates']),
+    'coordinates, vectorized (arrays)': best_time(split_coordinates, raw_df['geometry.coordinates']),
+    'full transform (CSV input)': best_time(transform_usgs_earthquake, csv_df),
+    'full transform (arrays)': best_time(transform_usgs_earthquake, raw_df)
+}
+
+baseline = results['coordinates, legacy eval (CSV input)']
+print(f'[INFO] USGS Earthquake transform, {args.rows} events, best of {args.repeat}:')
+for name, seconds in results.items():
+    print(f'[INFO]   {name:<40} {seconds * 1000:10.1f} ms  ({baseline / seconds:7.1f}x)')
@@ -3,11 +3,14 @@ import gspread as gs
 import pandas as pd
 import datetime as dt
 import json
-import io
+from gspread.utils import numericise_all
 from google.cloud import storage, bigquery
-from io import StringIO
 import os
 from dotenv import load_dotenv
+from utils import FILE_FORMATS, CONTENT_TYPES, serialize, deserialize, read_json_blob, write_json_blob, upload_bytes, download_bytes
+from backends import BACKENDS, LocalStorageClient, LocalWorksheet, SQLiteWarehouse, BigQueryWarehouse
+from transforms import diff_snapshot
+from metrics import add_metrics_arguments, start_run, log, phase, increment
 
 
 
@@ -21,84 +24,115 @@ bucket_name = os.getenv("FINANCE_BUCKET")
 folder_name = os.getenv("FINANCE_BUCKET_FOLDER")
 gsheet_url = os.getenv("FINANCE_GSHEET_URL")
 sheet_name = os.getenv("FINANCE_GSHEET_SHEET_NAME")
+snapshot_name = f'{folder_name}/{table}__snapshot.json'
+pending_snapshot_name = f'{folder_name}/{table}__snapshot_pending.json'
 
 # Parse command line arguments
 parser = argparse.ArgumentParser(prog='finance ETL')
 parser.add_argument('--step', action='store', required=True, choices=['extract', 'load'])
+parser.add_argument('--format', default='csv', choices=FILE_FORMATS, help='file format of the intermediate files')
+parser.add_argument('--server_side_deletes', action='store_true', help='find deleted ids with an anti-join in the warehouse instead of downloading every id')
+parser.add_argument('--snapshot_diff', action='store_true', help='detect inserted/updated/deleted rows by diffing row hashes against the previous run')
+parser.add_argument('--backend', default='cloud', choices=BACKENDS, help='local: keep the files in a folder and load into SQLite, both under --local_dir')
+parser.add_argument('--local_dir', default='local_data', help='root folder of the local backend')
+parser.add_argument('--local_sheet', help='with --backend local, CSV export of the sheet (default: <local_dir>/<sheet name>.csv)')
+add_metrics_arguments(parser)
 args = parser.parse_args()
+start_run('finance', args)
 
-client = storage.Client.from_service_account_json(service_account_creds)
-bq_client = bigquery.Client.from_service_account_json(service_account_creds)
 
-schema = bq_client.schema_from_json('/home/kevinesg/github/scripts/etl/batch/schema/finance__ledger.json')
+if args.backend == 'local':
+    client = LocalStorageClient(os.path.join(args.local_dir, 'storage'))
+    warehouse = SQLiteWarehouse(os.path.join(args.local_dir, 'warehouse.db'))
+else:
+    client = storage.Client.from_service_account_json(service_account_creds)
+    warehouse = BigQueryWarehouse(bigquery.Client.from_service_account_json(service_account_creds), project_id, dataset)
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema', 'finance__ledger.json')) as f:
+    schema = json.load(f)
 
 if args.step == 'extract':
 
     bucket = client.lookup_bucket(bucket_name)
     if bucket is None:
         bucket = client.create_bucket(bucket_name)
-        print(f'Bucket {bucket.name} created.')
+        log(f'Bucket {bucket.name} created.')
 
     blobs = bucket.list_blobs(prefix=f'{folder_name}/')
     blobs_list = [blob.name for blob in blobs]
 
     if f'{folder_name}/' not in blobs_list:
         bucket.blob(f'{folder_name}/').upload_from_string('')
-        print(f'{folder_name}/ folder created.')
+        log(f'{folder_name}/ folder created.')
 
-    print(f'[INFO] Processing table {table}...')
+    log(f'Processing table {table}...')
 
-    from google.cloud.exceptions import NotFound
-    try:
-        bq_client.get_table(f"{project_id}.{dataset}.{table}")
-        query = f"""
-            SELECT MAX(updated_at) AS max_updated_at
-            FROM `{project_id}.{dataset}.{table}`
-        """
-        rows = bq_client.query(query).result()
-        #rows.result()
-        for row in rows:
-            latest_update = row["max_updated_at"]
-            break
-        if latest_update is None:
+    warehouse.ensure_table(table, schema)
+    if args.snapshot_diff:
+        # Changed rows come from the snapshot diff, so the table's latest updated_at isn't needed
+        adjusted_updated_at = None
+    else:
+        latest_update = warehouse.query(f'SELECT MAX(updated_at) AS max_updated_at FROM {warehouse.quote(table)}')['max_updated_at'][0]
+        if pd.isna(latest_update):
             adjusted_updated_at = dt.datetime.strptime('2000-01-01 00:00:00', '%Y-%m-%d %H:%M:%S')
         else:
-            adjusted_updated_at = latest_update
-    
-    except NotFound:
-        bq_table = bigquery.Table(f"{project_id}.{dataset}.{table}", schema=schema)
-        bq_client.create_table(bq_table, exists_ok=True)
-        adjusted_updated_at = dt.datetime.strptime('2000-01-01 00:00:00', '%Y-%m-%d %H:%M:%S')
-    print(f'[INFO] {table} adjusted updated_at: {adjusted_updated_at}')
-
-    print(f'[INFO] Extracting raw data...')
-    gc = gs.service_account(filename=service_account_creds)
-    sh = gc.open_by_url(gsheet_url)
-    ws = sh.worksheet(sheet_name)
-    df = pd.DataFrame(ws.get_all_records())
-    df = df[pd.to_datetime(df['updated_at']) > adjusted_updated_at]
+            adjusted_updated_at = pd.to_datetime(latest_update)
+    if adjusted_updated_at is not None:
+        log(f'{table} adjusted updated_at: {adjusted_updated_at}')
+
+    log(f'Extracting raw data...')
+    if args.backend == 'local':
+        ws = LocalWorksheet(args.local_sheet or os.path.join(args.local_dir, f'{sheet_name}.csv'))
+    else:
+        gc = gs.service_account(filename=service_account_creds)
+        sh = gc.open_by_url(gsheet_url)
+        ws = sh.worksheet(sheet_name)
+
+    if args.snapshot_diff:
+
+        # Download the sheet once as raw values and diff per-row hashes against the
+        # snapshot from the last successful load, keyed by id
+        with phase('sheet_fetch'):
+            values:list = ws.get_all_values()
+        increment('requests')
+        previous_snapshot = read_json_blob(bucket, snapshot_name)
+        previous_hashes:dict = previous_snapshot['rows'] if previous_snapshot is not None else {}
+
+        # same value parsing as get_all_records(), but only for the changed rows
+        df, snapshot, inserted_ids = diff_snapshot(values, previous_hashes, numericise_all)
+        log(f'{len(inserted_ids)} inserted and {df.shape[0] - len(inserted_ids)} updated rows since the last snapshot.')
+        source_ids = set(snapshot)
+
+        # promoted to the current snapshot by the load step once the changes are in the warehouse
+        write_json_blob(bucket, pending_snapshot_name, {'rows': snapshot})
+
+    else:
+        with phase('sheet_fetch'):
+            records = ws.get_all_records()
+        increment('requests')
+        df = pd.DataFrame(records)
+        source_ids = set(df['id'])
+        df = df[pd.to_datetime(df['updated_at']) > adjusted_updated_at]
 
     # save raw df to GCS
-    blob = bucket.blob(f'{folder_name}/raw_data.csv')
-    blob.upload_from_string(df.to_csv(index=False), 'text/csv')
-    print(f'[INFO] Done saving raw data to GCS bucket.')
+    blob = bucket.blob(f'{folder_name}/raw_data.{args.format}')
+    increment('rows', df.shape[0])
+    upload_bytes(blob, serialize(df, args.format), CONTENT_TYPES[args.format])
+    log(f'Done saving raw data to GCS bucket.')
 
     # Get the ids of newly-deleted rows from the source
-    source_ids = set(pd.DataFrame(ws.get_all_records())['id'])
-    query = f"""
-        SELECT id
-        FROM `{project_id}.{dataset}.{table}`
-        WHERE NOT _is_deleted
-        """
-    bq_ids = bq_client.query(query).result()
-    bq_ids_set = set()
-    for row in bq_ids:
-        bq_ids_set.add(row["id"])
-    deleted_ids = list(bq_ids_set.difference(source_ids))
+    if args.snapshot_diff and previous_snapshot is not None:
+        deleted_ids = sorted(set(previous_hashes).difference(source_ids))
+    elif args.server_side_deletes:
+        # Anti-join the source ids in the warehouse so only the deleted ids come back
+        deleted_ids = sorted(str(id) for id in warehouse.missing_ids(table, 'id', [str(id) for id in source_ids], where='NOT _is_deleted'))
+    else:
+        warehouse_ids = warehouse.query(f'SELECT id FROM {warehouse.quote(table)} WHERE NOT _is_deleted')['id']
+        deleted_ids = sorted(set(str(id) for id in warehouse_ids).difference(str(id) for id in source_ids))
     df_deleted = pd.DataFrame(deleted_ids, columns=['deleted_ids'])
-    blob_deleted = bucket.blob(f'{table}__deleted_ids.csv')
-    blob_deleted.upload_from_string(df_deleted.to_csv(index=False), 'text/csv')
-    print(f'[INFO] Saved {table} deleted row ids to GCS bucket.')
+    blob_deleted = bucket.blob(f'{table}__deleted_ids.{args.format}')
+    upload_bytes(blob_deleted, serialize(df_deleted, args.format), CONTENT_TYPES[args.format])
+    log(f'Saved {table} deleted row ids to GCS bucket.')
 
 
 
@@ -107,97 +141,74 @@ if args.step == 'load':
 
     try:
         bucket = client.lookup_bucket(bucket_name)
-        data_blob = bucket.get_blob(f'{folder_name}/raw_data.csv')
-        data_bytes = data_blob.download_as_bytes()
-        data_buffer = io.BytesIO(data_bytes)
-        df = pd.read_csv(data_buffer)
+        data_blob = bucket.get_blob(f'{folder_name}/raw_data.{args.format}')
+        df = deserialize(download_bytes(data_blob), args.format)
     except Exception as e:
-        print(f'[ERROR] Error reading raw data: {e}')
+        log(f'Error reading raw data: {e}', level='ERROR')
         exit(1)
     
     try:
-        deleted_blob = bucket.get_blob(f'{table}__deleted_ids.csv')
-        data_str = deleted_blob.download_as_string()
-        data_file = io.StringIO(data_str.decode('utf-8'))
-        df_deleted = pd.read_csv(data_file)
+        deleted_blob = bucket.get_blob(f'{table}__deleted_ids.{args.format}')
+        df_deleted = deserialize(download_bytes(deleted_blob), args.format)
     except Exception as e:
-        print(f'[ERROR] Error reading deleted row ids: {e}')
+        log(f'Error reading deleted row ids: {e}', level='ERROR')
         exit(1)
 
     df['_inserted_at'] = dt.datetime.now(dt.UTC)
     df['_is_deleted'] = False
 
-    print(f'[INFO] {df.shape[0]} new/updated rows for table {table}')
+    log(f'{df.shape[0]} new/updated rows for table {table}')
+
+    deleted_ids = [str(deleted_id) for deleted_id in df_deleted['deleted_ids']]
+    log(f'{len(deleted_ids)} deleted rows for table {table}')
 
     try:
-        print(f'[INFO] {df.shape[0]} new/updated rows being upserted in table {table}...')
-        temporary_table_id = f'{dataset}.{table}__temp_table'
-        job_config = bigquery.LoadJobConfig(
-            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE
-        )
-        job_config.schema = schema
-        bq_client.load_table_from_dataframe(df, temporary_table_id, job_config=job_config).result()
-
-        merge_query = f"""
-        MERGE INTO `{dataset}.{table}` AS target
-        USING `{temporary_table_id}` AS source
-        ON target.id = source.id
-        WHEN MATCHED THEN
-        UPDATE SET {', '.join([f"target.`{col}` = source.`{col}`" for col in df.columns])}
-        WHEN NOT MATCHED THEN
-        INSERT ({', '.join([f"`{col}`" for col in df.columns])})
-        VALUES ({', '.join([f"source.`{col}`" for col in df.columns])})
-        """
-        print(merge_query)
-        job = bq_client.query(merge_query)
-        job.result()
-
-        bq_client.delete_table(temporary_table_id)
+        log(f'{df.shape[0]} new/updated rows being upserted in table {table}...')
+        # Unchanged rows are skipped and the soft-delete is committed together with the upsert
+        data_columns = [col for col in df.columns if col not in ['_inserted_at', '_is_deleted']]
+        with phase('load_job'), warehouse.transaction():
+            increment('rows_loaded', warehouse.merge(table, df, key='id', compare_columns=data_columns + ['_is_deleted']))
+            warehouse.update(
+                table,
+                {'_is_deleted': True, '_inserted_at': dt.datetime.now(dt.UTC)},
+                key='id',
+                ids=deleted_ids,
+                where='NOT _is_deleted'
+            )
 
     except Exception as e:
-        print(f'[ERROR] Error upserting new/updated rows; {e}')
+        log(f'Error upserting new/updated/deleted rows; {e}', level='ERROR')
         exit(1)
-        
-    values_deleted = df_deleted['deleted_ids'].tolist()
-    if values_deleted != []:
-        print(f'[INFO] {len(values_deleted)} deleted rows being updated in table {table}...')
-        # remove comma if only one element; logic can probably be improved/simplified
-        if len(values_deleted) == 1:
-            delete_ids = str(tuple(df_deleted['deleted_ids'])).replace(',', '')
-        else:
-            delete_ids = tuple(df_deleted['deleted_ids'])
-        # Update is_deleted for newly-deleted rows
-        update_query_deleted = f"""
-            UPDATE {project_id}.{dataset}.{table}
-            SET
-                _is_deleted = TRUE,
-                uploaded_to_bq = CURRENT_TIMESTAMP
-            WHERE id IN {delete_ids}
-            """
-        bq_client.query(update_query_deleted)
 
     try:
-        blob_name = f'{folder_name}/raw_data.csv'
+        blob_name = f'{folder_name}/raw_data.{args.format}'
         bucket = client.bucket(bucket_name)
         blob = bucket.blob(blob_name)
 
         # Delete the blob
         blob.delete()
-        print(f"[INFO] Deleted temp file: {folder_name}/raw_data.csv")
+        log(f"Deleted temp file: {blob_name}")
 
     except Exception as e:
-        print(f"[INFO] Error deleting file {folder_name}/raw_data.csv: {e}")
+        log(f"Error deleting file {blob_name}: {e}", level='WARNING')
     
     try:
-        del_blob_name = f'{table}__deleted_ids.csv'
+        del_blob_name = f'{table}__deleted_ids.{args.format}'
         bucket = client.bucket(bucket_name)
         del_blob = bucket.blob(del_blob_name)
 
         # Delete the blob
         del_blob.delete()
-        print(f"[INFO] Deleted temp file: {table}__deleted_ids.csv")
+        log(f"Deleted temp file: {del_blob_name}")
 
     except Exception as e:
-        print(f"[INFO] Error deleting file {table}__deleted_ids.csv: {e}")
+        log(f"Error deleting file {del_blob_name}: {e}", level='WARNING')
     
-    print(f'[INFO] Done updating table {table}!')
\ No newline at end of file
+    # The changes are in the warehouse, so the next snapshot diff can start from this run's sheet
+    pending_snapshot = bucket.get_blob(pending_snapshot_name)
+    if pending_snapshot is not None:
+        bucket.copy_blob(pending_snapshot, bucket, snapshot_name)
+        pending_snapshot.delete()
+        log(f'Saved {table} snapshot.')
+
+    log(f'Done updating table {table}!')
\ No newline at end of file
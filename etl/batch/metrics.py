@@ -0,0 +1,193 @@
+import os
+import sys
+import json
+import time
+import atexit
+import cProfile
+import resource
+import threading
+import tracemalloc
+import contextlib
+import datetime as dt
+
+
+
+
+# Shared instrumentation for the batch pipelines. A run is one step of one pipeline:
+# start_run() is called once after parsing the arguments, the helpers in utils and
+# pipeline time their own phases (http_fetch, serialize, upload, load_job, ...), and
+# when the process exits the step's summary is logged as a JSON line and written as
+# a Prometheus textfile for node_exporter's textfile collector
+
+run:dict = {
+    'pipeline': None,
+    'step': None,
+    'started_at': time.time(),
+    'status': 'success',
+    'phases': {},
+    'counts': {},
+    'metrics_dir': None,
+    'profiler': None,
+    'profile_dir': None
+}
+lock = threading.Lock()
+
+
+def add_metrics_arguments(parser) -> None:
+
+    parser.add_argument('--metrics_dir', default=os.getenv('METRICS_TEXTFILE_DIR'), help='folder for the Prometheus textfile of the run (default: $METRICS_TEXTFILE_DIR; skipped if unset)')
+    parser.add_argument('--profile', action='store_true', help='dump cProfile stats and a tracemalloc snapshot of the step to --profile_dir')
+    parser.add_argument('--profile_dir', default='profiles', help='folder for the --profile dumps')
+
+
+def log(message:str, level:str='INFO', **fields) -> None:
+
+    # One JSON object per line, so log shippers don't have to parse free text
+    if level == 'ERROR':
+        run['status'] = 'failed'
+    record = {
+        'time': dt.datetime.now(dt.timezone.utc).isoformat(timespec='milliseconds'),
+        'level': level,
+        'pipeline': run['pipeline'],
+        'step': run['step'],
+        'message': message,
+        **fields
+    }
+    print(json.dumps(record, default=str), flush=True)
+
+
+@contextlib.contextmanager
+def phase(name:str):
+
+    # Phases run concurrently in the thread pools, so their times are summed across
+    # threads and can add up to more than the step's wall time
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with lock:
+            totals = run['phases'].setdefault(name, {'seconds': 0.0, 'calls': 0})
+            totals['seconds'] += seconds
+            totals['calls'] += 1
+
+
+def increment(name:str, value:int=1) -> None:
+
+    with lock:
+        run['counts'][name] = run['counts'].get(name, 0) + value
+
+
+def peak_rss() -> dict:
+
+    # ru_maxrss is in kilobytes on Linux; children covers the transform process pools
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    }
+
+
+def start_run(pipeline:str, args) -> None:
+
+    run.update({
+        'pipeline': pipeline,
+        'step': args.step,
+        'started_at': time.time(),
+        'metrics_dir': args.metrics_dir
+    })
+
+    if args.profile:
+        # cProfile only sees the main thread; tracemalloc sees every thread
+        run['profile_dir'] = args.profile_dir
+        tracemalloc.start(25)
+        run['profiler'] = cProfile.Profile()
+        run['profiler'].enable()
+
+    # Uncaught exceptions still get a summary, marked as failed
+    excepthook = sys.excepthook
+    def failed_excepthook(*exc_info):
+        run['status'] = 'failed'
+        excepthook(*exc_info)
+    sys.excepthook = failed_excepthook
+
+    atexit.register(finish_run)
+    log('Step started.')
+
+
+def write_profile(prefix:str) -> None:
+
+    run['profiler'].disable()
+    os.makedirs(run['profile_dir'], exist_ok=True)
+    run['profiler'].dump_stats(f'{prefix}.prof')
+
+    # Leave out the profiler's own allocations
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, cProfile.__file__),
+        tracemalloc.Filter(False, tracemalloc.__file__)
+    ])
+    tracemalloc.stop()
+    snapshot.dump(f'{prefix}.tracemalloc')
+    top_allocations = [str(stat) for stat in snapshot.statistics('lineno')[:10]]
+    log('Profile written.', cprofile=f'{prefix}.prof', tracemalloc=f'{prefix}.tracemalloc', top_allocations=top_allocations)
+
+
+def to_prometheus(summary:dict) -> str:
+
+    labels = f'pipeline="{summary["pipeline"]}",step="{summary["step"]}"'
+    lines = [
+        '# HELP etl_step_duration_seconds Wall time of the last run of the step.',
+        '# TYPE etl_step_duration_seconds gauge',
+        f'etl_step_duration_seconds{{{labels}}} {summary["duration_seconds"]}',
+        '# HELP etl_step_success Whether the last run of the step succeeded.',
+        '# TYPE etl_step_success gauge',
+        f'etl_step_success{{{labels}}} {int(summary["status"] == "success")}',
+        '# HELP etl_step_last_run_timestamp_seconds When the last run of the step finished.',
+        '# TYPE etl_step_last_run_timestamp_seconds gauge',
+        f'etl_step_last_run_timestamp_seconds{{{labels}}} {summary["finished_at"]}',
+        '# HELP etl_step_peak_rss_bytes Peak resident set size of the last run of the step.',
+        '# TYPE etl_step_peak_rss_bytes gauge'
+    ]
+    lines += [f'etl_step_peak_rss_bytes{{{labels},process="{process}"}} {value}' for process, value in summary['peak_rss_bytes'].items()]
+
+    lines += [
+        '# HELP etl_phase_duration_seconds Time spent in each phase of the last run, summed across threads.',
+        '# TYPE etl_phase_duration_seconds gauge'
+    ]
+    lines += [f'etl_phase_duration_seconds{{{labels},phase="{name}"}} {totals["seconds"]}' for name, totals in summary['phases'].items()]
+    lines += [
+        '# HELP etl_phase_calls Number of times each phase ran in the last run.',
+        '# TYPE etl_phase_calls gauge'
+    ]
+    lines += [f'etl_phase_calls{{{labels},phase="{name}"}} {totals["calls"]}' for name, totals in summary['phases'].items()]
+
+    for name, value in summary['counts'].items():
+        lines += [f'# TYPE etl_{name} gauge', f'etl_{name}{{{labels}}} {value}']
+
+    return '\n'.join(lines) + '\n'
+
+
+def finish_run() -> None:
+
+    finished_at = time.time()
+    if run['profiler'] is not None:
+        write_profile(os.path.join(run['profile_dir'], f'{run["pipeline"]}__{run["step"]}__{dt.datetime.now():%Y%m%dT%H%M%S}'))
+
+    summary = {
+        'pipeline': run['pipeline'],
+        'step': run['step'],
+        'status': run['status'],
+        'finished_at': round(finished_at, 3),
+        'duration_seconds': round(finished_at - run['started_at'], 3),
+        'phases': {name: {'seconds': round(totals['seconds'], 3), 'calls': totals['calls']} for name, totals in run['phases'].items()},
+        'counts': run['counts'],
+        'peak_rss_bytes': peak_rss()
+    }
+    log('Step finished.', **{key: value for key, value in summary.items() if key not in ('pipeline', 'step')})
+
+    if run['metrics_dir'] is not None:
+        # Written atomically so the collector never reads a partial file
+        os.makedirs(run['metrics_dir'], exist_ok=True)
+        prom_file = os.path.join(run['metrics_dir'], f'{run["pipeline"]}__{run["step"]}.prom')
+        with open(f'{prom_file}.tmp', 'w') as f:
+            f.write(to_prometheus(summary))
+        os.replace(f'{prom_file}.tmp', prom_file)
@@ -1,16 +1,23 @@
 import requests
 import json
 import time
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 import pandas as pd
-import pandas_gbq
 import boto3
 from botocore.exceptions import ClientError
 from google.cloud import bigquery
-from io import StringIO
-from google.oauth2 import service_account
 import os
 from dotenv import load_dotenv
 import argparse
+import csv
+import tempfile
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import fs
+from utils import FILE_FORMATS, CONTENT_TYPES, TokenBucket, get_with_retry, serialize, deserialize
+from backends import BACKENDS, LocalS3Client, SQLiteWarehouse, BigQueryWarehouse, local_s3_filesystem
+from metrics import add_metrics_arguments, start_run, log, phase, increment
 
 
 
@@ -28,18 +35,104 @@ transformed_folder_name = os.getenv("NYC_OPENDATA_FHV_BUCKET_TRANSFORMED_FOLDER"
 endpoint = os.getenv("NYC_OPENDATA_FHV_ENDPOINT")
 query_params = {
     '$limit': 10000,
-    '$offset': 0
+    '$offset': 0,
+    '$order': ':id' # stable ordering so that concurrently-fetched pages don't overlap
 }
 
 # Parse command line arguments
 parser = argparse.ArgumentParser(prog='nyc opendata FHV ETL')
 parser.add_argument('--step', action='store', required=True, choices=["extract", "transform", "load"])
+parser.add_argument('--workers', type=int, default=4, help='number of pages fetched concurrently (extract) or chunks transformed in parallel processes (transform)')
+parser.add_argument('--requests_per_minute', type=float, default=30, help='API rate limit')
+parser.add_argument('--format', default='csv', choices=FILE_FORMATS, help='file format of the raw/transformed chunks')
+parser.add_argument('--streaming', action='store_true', help='transform chunks in record batches with constant memory')
+parser.add_argument('--overwrite', action='store_true', help='re-transform chunks that already have a transformed counterpart')
+parser.add_argument('--batch_size', type=int, default=50000, help='rows per record batch when streaming')
+parser.add_argument('--load_mode', default='bulk', choices=['bulk', 'append'], help='bulk: single load job + atomic swap; append: one load job per chunk')
+parser.add_argument('--append_interval', type=float, default=60, help='seconds to wait between the load jobs of --load_mode append')
+parser.add_argument('--backend', default='cloud', choices=BACKENDS, help='local: keep the chunks in a folder and load into SQLite, both under --local_dir')
+parser.add_argument('--local_dir', default='local_data', help='root folder of the local backend')
+add_metrics_arguments(parser)
 args = parser.parse_args()
+start_run('nyc_opendata_fhv', args)
 
-if args.step == "extract":
+
+def extract_chunk(s3, session:requests.Session, rate_limiter:TokenBucket, offset:int) -> int:
+
+    chunk_size:int = query_params['$limit']
+    chunk_number:int = offset // chunk_size + 1
+
+    # Extract data from API
+    log(f'Extracting chunk {chunk_number} from API...')
+    response = get_with_retry(session, endpoint, params={**query_params, '$offset': offset}, rate_limiter=rate_limiter)
+    data:list = response.json()
+
+    if not data:
+        return 0
+
+    with phase('parse'):
+        df:pd.DataFrame = pd.json_normalize(data)
+    increment('rows', df.shape[0])
+    log(f'Done extracting chunk {chunk_number}.')
+
+    log(f'Saving chunk {chunk_number} to s3 bucket...')
+    body:bytes = serialize(df, args.format)
+    with phase('upload'):
+        s3.put_object(
+            Bucket=bucket_name,
+            Key=f'{raw_folder_name}/chunk_{chunk_number}.{args.format}',
+            Body=body,
+            ContentType=CONTENT_TYPES[args.format]
+        )
+    increment('uploaded_bytes', len(body))
+    log(f'Done saving chunk {chunk_number} to s3 bucket.')
+
+    return len(data)
+
+
+def transform_batch(df:pd.DataFrame) -> pd.DataFrame:
+
+    # Apply transformations to the chunk
+    
+
+    return df
+
+
+def transform_chunk_streaming(s3fs:fs.FileSystem, key:str, transformed_key:str) -> int:
+
+    # Reads the chunk `batch_size` rows at a time and writes each transformed batch to
+    # an S3 output stream, which is uploaded in parts (multipart upload) as it fills up
+    source_path = f'{bucket_name}/{key}'
+    sink_path = f'{bucket_name}/{transformed_key}'
+    num_rows = 0
+    with s3fs.open_output_stream(sink_path, compression=None, metadata={'Content-Type': CONTENT_TYPES[args.format]}) as sink:
+
+        if args.format == 'parquet':
+            # Every batch is written with the source file's schema, since the types pandas
+            # infers can differ between batches (e.g. a column that's all null in one)
+            parquet_file = pq.ParquetFile(s3fs.open_input_file(source_path))
+            schema = parquet_file.schema_arrow
+            with pq.ParquetWriter(sink, schema, compression='zstd') as writer:
+                for batch in parquet_file.iter_batches(batch_size=args.batch_size):
+                    df = transform_batch(batch.to_pandas())
+                    num_rows += df.shape[0]
+                    writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+
+        else:
+            with s3fs.open_input_stream(source_path, compression=None) as source:
+                for i, df in enumerate(pd.read_csv(source, chunksize=args.batch_size)):
+                    num_rows += df.shape[0]
+                    sink.write(transform_batch(df).to_csv(index=False, header=(i == 0)).encode('utf-8'))
+
+    return num_rows
+
+
+def get_s3_client():
+
+    if args.backend == 'local':
+        return LocalS3Client(os.path.join(args.local_dir, 's3'))
 
     # Load AWS access key ID and secret access key from your rootkey.csv
-    print(f'[INFO] Creating s3 client...')
     rootkey:pd.DataFrame = pd.read_csv(aws_service_account_creds)
     # Create a session using your credentials
     session = boto3.Session(
@@ -47,15 +140,93 @@ if args.step == "extract":
         aws_secret_access_key=rootkey['Secret access key'][0],
         region_name=aws_region
     )
+    return session.client('s3')
+
+
+def get_s3_filesystem() -> fs.FileSystem:
+
+    if args.backend == 'local':
+        return local_s3_filesystem(os.path.join(args.local_dir, 's3'))
+
+    rootkey:pd.DataFrame = pd.read_csv(aws_service_account_creds)
+    return fs.S3FileSystem(
+        access_key=rootkey['Access key ID'][0],
+        secret_key=rootkey['Secret access key'][0],
+        region=aws_region
+    )
+
+
+def get_warehouse():
+
+    if args.backend == 'local':
+        return SQLiteWarehouse(os.path.join(args.local_dir, 'warehouse.db'))
+    return BigQueryWarehouse(bigquery.Client.from_service_account_json(gcp_service_account_creds), project_id, dataset)
+
+
+def create_s3_clients() -> None:
+
+    # Each transform worker process gets its own clients; they can't be shared across a fork
+    global s3, s3fs
+    s3 = get_s3_client()
+    s3fs = get_s3_filesystem()
+
+
+def transform_chunk(key:str) -> tuple:
+
+    file_name = key.split('/')[-1]
+    transformed_key = f'{transformed_folder_name}/transformed_{file_name}'
+    log(f'Processing {file_name}...')
+
+    if args.streaming:
+        return transformed_key, transform_chunk_streaming(s3fs, key, transformed_key)
+
+    # Get the chunk from S3
+    obj = s3.get_object(Bucket=bucket_name, Key=key)
+    df = transform_batch(deserialize(obj['Body'].read(), args.format))
+
+    # Write the transformed chunk back to S3 (or to a new file)
+    s3.put_object(
+        Bucket=bucket_name,
+        Key=transformed_key,
+        Body=serialize(df, args.format),
+        ContentType=CONTENT_TYPES[args.format]
+    )
+    return transformed_key, df.shape[0]
+
+
+def get_field_type(dtype) -> str:
+
+    # BigQuery types of the columns as pandas reads them from the CSV chunks, the same
+    # ones to_gbq would pick; timestamps stay strings like they were before bulk loads
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'BOOLEAN'
+    if pd.api.types.is_integer_dtype(dtype):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'FLOAT'
+    return 'STRING'
+
+
+def merge_field_types(field_type:str, other:str) -> str:
+
+    # A column can be read as integers from one chunk and as floats (nulls) from another
+    if field_type is None or field_type == other:
+        return other
+    if {field_type, other} == {'INTEGER', 'FLOAT'}:
+        return 'FLOAT'
+    return 'STRING'
+
+
+if args.step == "extract":
 
-    # Create an S3 client
-    s3 = session.client('s3')
-    print(f'[INFO] Done creating s3 client.')
+    log(f'Creating s3 client...')
+    s3 = get_s3_client()
+    log(f'Done creating s3 client.')
 
     # check if bucket already exists
     try:
         s3.head_bucket(Bucket=bucket_name)
-        print(f'[INFO] s3 bucket already exists.')
+        log(f's3 bucket already exists.')
     except ClientError:
         # The bucket does not exist or you have no access.
         s3.create_bucket(
@@ -64,152 +235,192 @@ if args.step == "extract":
                 'LocationConstraint': aws_region
             }
         )
-        print(f'Bucket {bucket_name} created.')
+        log(f'Bucket {bucket_name} created.')
 
     # Check if raw folder exists
     result = s3.list_objects(Bucket=bucket_name, Prefix=f'{raw_folder_name}/')
     if 'Contents' not in result:
         s3.put_object(Bucket=bucket_name, Key=(f'{raw_folder_name}/'))
-        print(f'{raw_folder_name}/ folder created.')
-
-    while True:
-        # Extract data from API
-        chunk_size:int = query_params['$limit']
-        offset:int = query_params['$offset']
-        print(f'[INFO] Extracting chunk {offset // chunk_size + 1} from API...')
-        response = requests.get(endpoint, params=query_params)
-        data:list = response.json()
-        
-        if not data:
-            break
+        log(f'{raw_folder_name}/ folder created.')
 
-        df:pd.DataFrame = pd.json_normalize(data)
-        print(f'[INFO] Done extracting chunk {offset // chunk_size + 1}.')
+    http_session = requests.Session()
+    http_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=args.workers))
+    rate_limiter = TokenBucket(rate=args.requests_per_minute / 60)
 
-        print(f'[INFO] Saving chunk {offset // chunk_size + 1} to s3 bucket...')
-        csv_buffer = StringIO()
-        df.to_csv(csv_buffer, index=False)
-        s3.put_object(Bucket=bucket_name, Key=f'{raw_folder_name}/chunk_{offset // chunk_size + 1}.csv', Body=csv_buffer.getvalue())
+    # Keep `workers` pages in flight until a short/empty page marks the end of the dataset
+    chunk_size:int = query_params['$limit']
+    next_offset:int = query_params['$offset']
+    end_offset:float = float('inf')
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {}
+        while True:
+            while len(futures) < args.workers and next_offset < end_offset:
+                future = executor.submit(extract_chunk, s3, http_session, rate_limiter, next_offset)
+                futures[future] = next_offset
+                next_offset += chunk_size
 
-        print(f'[INFO] Done saving chunk {offset // chunk_size + 1} to s3 bucket.')
-        
-        query_params.update({'$offset': query_params['$offset'] + query_params['$limit']})
+            if not futures:
+                break
 
-        print(f'[INFO] Waiting 1 minute before extracting the next chunk...')
-        time.sleep(60)
-    
-    print('Done saving complete data.')
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                offset = futures.pop(future)
+                if future.result() < chunk_size:
+                    end_offset = min(end_offset, offset + chunk_size)
 
+    log('Done saving complete data.')
 
 
 
-if args.step == "transform":
 
-    # Load AWS access key ID and secret access key from your rootkey.csv
-    print(f'[INFO] Creating s3 client...')
-    rootkey:pd.DataFrame = pd.read_csv(aws_service_account_creds)
-    # Create a session using your credentials
-    session = boto3.Session(
-        aws_access_key_id=rootkey['Access key ID'][0],
-        aws_secret_access_key=rootkey['Secret access key'][0],
-        region_name=aws_region
-    )
+if args.step == "transform":
 
-    # Create an S3 client
-    s3 = session.client('s3')
-    print(f'[INFO] Done creating s3 client.')
+    log(f'Creating s3 client...')
+    s3 = get_s3_client()
+    log(f'Done creating s3 client.')
 
     # Check if transformed folder exists
     result = s3.list_objects(Bucket=bucket_name, Prefix=f'{transformed_folder_name}/')
     if 'Contents' not in result:
         s3.put_object(Bucket=bucket_name, Key=(f'{transformed_folder_name}/'))
-        print(f'{transformed_folder_name}/ folder created.')
-
-    # List all CSV files in the folder
-    response = s3.list_objects_v2(Bucket=bucket_name, Prefix=raw_folder_name)
-    all_files = [file['Key'] for file in response['Contents'] if file['Key'].endswith('.csv')]
-
-    for file in all_files:
-        file_name = file.split('/')[-1]
-        print(f'[INFO] Processing {file_name}...')
-        # Get the CSV file from S3
-        csv_obj = s3.get_object(Bucket=bucket_name, Key=file)
-        body = csv_obj['Body']
-        csv_string = body.read().decode('utf-8')
-        df = pd.read_csv(StringIO(csv_string))
-
-        # Apply transformations to the chunk
-        
+        log(f'{transformed_folder_name}/ folder created.')
+
+    # List all raw and transformed chunks; list_objects_v2 returns at most 1000 keys per call
+    paginator = s3.get_paginator('list_objects_v2')
+    raw_files = [
+        file['Key']
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=f'{raw_folder_name}/')
+        for file in page.get('Contents', [])
+        if file['Key'].endswith(f'.{args.format}')
+    ]
+    transformed_files = set(
+        file['Key']
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=f'{transformed_folder_name}/')
+        for file in page.get('Contents', [])
+    )
+    all_files = [
+        file for file in raw_files
+        if args.overwrite or f'{transformed_folder_name}/transformed_{file.split("/")[-1]}' not in transformed_files
+    ]
+    log(f'{len(all_files)} of {len(raw_files)} chunks to transform.')
 
-        # Write the transformed chunk back to S3 (or to a new file)
-        csv_buffer = StringIO()
-        df.to_csv(csv_buffer, index=False)
-        s3.put_object(Bucket=bucket_name, Key=f'{transformed_folder_name}/transformed_{file_name}', Body=csv_buffer.getvalue())
+    # fork so that the workers inherit the parsed arguments instead of re-running this script
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=multiprocessing.get_context('fork'),
+        initializer=create_s3_clients
+    ) as executor:
+        # Phases timed inside the worker processes aren't collected, so the
+        # row counts come back with the results
+        for transformed_key, num_rows in executor.map(transform_chunk, all_files):
+            increment('rows', num_rows)
+            increment('chunks')
+            log(f'Done saving {transformed_key} to s3 bucket.')
 
-    print('[INFO] Done with the transformation process.')
+    log('Done with the transformation process.')
 
 
 
 
 if args.step == "load":
 
-    # Load AWS access key ID and secret access key from your rootkey.csv
-    print(f'[INFO] Creating s3 client...')
-    rootkey:pd.DataFrame = pd.read_csv(aws_service_account_creds)
-    
-    # Create a session using your credentials
-    session = boto3.Session(
-        aws_access_key_id=rootkey['Access key ID'][0],
-        aws_secret_access_key=rootkey['Secret access key'][0],
-        region_name=aws_region
-    )
-
-    s3 = session.resource('s3')
-    bucket = s3.Bucket(bucket_name)
+    s3 = get_s3_client()
+    paginator = s3.get_paginator('list_objects_v2')
+    transformed_keys = [
+        file['Key']
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=transformed_folder_name)
+        for file in page.get('Contents', [])
+        if file['Key'].endswith(f'.{args.format}')
+    ]
+
+    warehouse = get_warehouse()
+
+    if args.load_mode == 'bulk' and not transformed_keys:
+
+        # Nothing to stage; empty the table like a load of zero chunks would
+        if warehouse.table_exists(table):
+            warehouse.delete(table)
+        log(f'No transformed chunks; all old rows deleted from {table}.')
+        exit(0)
+
+    if args.load_mode == 'bulk':
+
+        if args.format == 'parquet':
+
+            with tempfile.TemporaryDirectory() as staging_dir:
+
+                # Chunks can have different columns (the API omits null fields), so
+                # download them first and unify their schemas from the parquet footers
+                paths = []
+                for key in transformed_keys:
+                    path = os.path.join(staging_dir, key.split('/')[-1])
+                    with phase('download'):
+                        s3.download_file(bucket_name, key, path)
+                    increment('downloaded_bytes', os.path.getsize(path))
+                    paths.append(path)
+                schema = pa.unify_schemas([pq.read_schema(path) for path in paths], promote_options='permissive')
+
+                # Stage all chunks into one parquet file, one chunk in memory at a time
+                staging_path = os.path.join(staging_dir, 'staging.parquet')
+                with phase('stage'), pq.ParquetWriter(staging_path, schema, compression='zstd') as writer:
+                    for path in paths:
+                        log(f'Staging {path.split("/")[-1]}...')
+                        chunk = pq.read_table(path)
+                        writer.write_table(pa.table([
+                            chunk[field.name].cast(field.type) if field.name in chunk.column_names
+                            else pa.nulls(chunk.num_rows, field.type)
+                            for field in schema
+                        ], schema=schema))
+                        os.remove(path)
+
+                # Loaded into a staging table that then replaces the target atomically
+                log(f'Loading {len(transformed_keys)} chunks to {table}...')
+                with open(staging_path, 'rb') as staging_file, phase('load_job'):
+                    increment('rows_loaded', warehouse.replace(table, staging_file, 'parquet', batch_size=args.batch_size))
+
+        else:
+
+            # Chunks can have different columns (the API omits null fields), so collect
+            # the union of all headers first by reading only the start of each object
+            columns = []
+            for key in transformed_keys:
+                head = s3.get_object(Bucket=bucket_name, Key=key, Range='bytes=0-65535')['Body'].read().decode('utf-8').splitlines()
+                for col in next(csv.reader(head[:1]), []):
+                    if col not in columns:
+                        columns.append(col)
+
+            with tempfile.TemporaryFile() as staging_file:
+
+                # Stage all chunks into one local file, one chunk in memory at a time
+                field_types = {}
+                for i, key in enumerate(transformed_keys):
+                    log(f'Staging {key}...')
+                    with phase('stage'):
+                        df = pd.read_csv(s3.get_object(Bucket=bucket_name, Key=key)['Body'])
+                        df.reindex(columns=columns).to_csv(staging_file, index=False, header=(i == 0))
+                    for col, dtype in df.dtypes.items():
+                        field_types[col] = merge_field_types(field_types.get(col), get_field_type(dtype))
+                staging_file.seek(0)
+
+                # New columns get the type pandas read them as
+                log(f'Loading {len(transformed_keys)} chunks to {table}...')
+                with phase('load_job'):
+                    increment('rows_loaded', warehouse.replace(table, staging_file, 'csv', field_types, batch_size=args.batch_size))
 
-    credentials = service_account.Credentials.from_service_account_file(gcp_service_account_creds)
-    pandas_gbq.context.credentials = credentials
-
-    # Create a bigquery client
-    gbq_client = bigquery.Client.from_service_account_json(gcp_service_account_creds)
-    datasets = list(gbq_client.list_datasets())
-    dataset_list = [dataset.dataset_id for dataset in datasets]
-    if dataset not in dataset_list:
-        gbq_client.create_dataset(bigquery.Dataset(gbq_client.dataset(dataset)))
-    
-    tables = list(gbq_client.list_tables(dataset))
-    table_list = [table.table_id for table in tables]
-    if table not in table_list:
-        gbq_client.create_table(bigquery.Table(f'{project_id}.{dataset}.{table}'))
-    
     else:
-    # Set up the query
-        query = f"DELETE FROM `{dataset}.{table}` WHERE TRUE"
 
-        # Run the query
-        query_job = gbq_client.query(query)  # API request
-        rows = query_job.result()  # Waits for query to finish
-
-    print(f'[INFO] All old rows deleted from {dataset}.{table}.')
-    
-    for obj in bucket.objects.filter(Prefix=transformed_folder_name):
-        # Check if the object is a CSV file
-        if obj.key.endswith('.csv'):
-            # Download the file from S3
-            data_str = obj.get()['Body'].read().decode('utf-8')
-            data_file = StringIO(data_str)
-            
-            # Read the file object into a pandas DataFrame
-            df = pd.read_csv(data_file)
-
-            print(f'[INFO] Ingesting {obj} to GBQ...')
-            df.to_gbq(
-                destination_table=f'{dataset}.{table}',
-                project_id=project_id,
-                if_exists='append'
-            )
-        
-        print(f'[INFO] Waiting 1 minute before ingesting the next chunk...')
-        time.sleep(60)
-
-    print(f'[INFO] Done ingesting data to GBQ.')
\ No newline at end of file
+        if warehouse.table_exists(table):
+            warehouse.delete(table)
+        log(f'All old rows deleted from {table}.')
+
+        for i, key in enumerate(transformed_keys):
+            if i > 0 and args.append_interval > 0:
+                log(f'Waiting {args.append_interval:g} seconds before ingesting the next chunk...')
+                time.sleep(args.append_interval)
+
+            log(f'Ingesting {key} to {table}...')
+            with phase('download'):
+                data:bytes = s3.get_object(Bucket=bucket_name, Key=key)['Body'].read()
+            increment('downloaded_bytes', len(data))
+            with phase('load_job'):
+                increment('rows_loaded', warehouse.append(table, deserialize(data, args.format)))
@@ -1,12 +1,17 @@
 import argparse
+import json
 import requests
 from datetime import datetime, timedelta, timezone
 import pandas as pd
-import pandas_gbq
-from google.cloud import storage, bigquery
-from io import StringIO
+from google.cloud import storage
+from concurrent.futures import ThreadPoolExecutor
 import os
 from dotenv import load_dotenv
+from utils import FILE_FORMATS, CONTENT_TYPES, TokenBucket, get_with_retry, serialize, deserialize, read_json_blob, write_json_blob, record_pending, list_unprocessed_blobs, mark_processed, upload_bytes, download_bytes
+from transforms import normalize_weather, transform_openweather
+from pipeline import get_storage_client, get_bigquery_client, get_bucket
+from backends import BigQueryWarehouse
+from metrics import add_metrics_arguments, start_run, log, phase, increment
 
 
 
@@ -20,6 +25,10 @@ table = os.getenv("OPENWEATHER_TABLE")
 bucket_name = os.getenv("OPENWEATHER_BUCKET")
 raw_folder_name = os.getenv("OPENWEATHER_BUCKET_RAW_FOLDER")
 transformed_folder_name = os.getenv("OPENWEATHER_BUCKET_TRANSFORMED_FOLDER")
+compacted_folder_name = os.getenv("OPENWEATHER_BUCKET_COMPACTED_FOLDER")
+load_state_name = os.getenv("OPENWEATHER_BUCKET_LOAD_STATE")
+transform_manifest_name = os.getenv("OPENWEATHER_BUCKET_TRANSFORM_MANIFEST")
+pending_folder_name = os.getenv("OPENWEATHER_BUCKET_PENDING_FOLDER")
 
 query_params = {
     'lat': os.getenv("OPENWEATHER_LATITUDE"),
@@ -29,8 +38,68 @@ query_params = {
 
 # Parse command line arguments
 parser = argparse.ArgumentParser(prog='finance ETL')
-parser.add_argument('--step', action='store', required=True, choices=['extract', 'transform', 'load'])
+parser.add_argument('--step', action='store', required=True, choices=['extract', 'compact', 'transform', 'load', 'all'])
+parser.add_argument('--format', default='csv', choices=FILE_FORMATS, help='file format of the raw/transformed files')
+parser.add_argument('--archive_raw', action='store_true', help='with --step all, also save the raw snapshot to the bucket')
+parser.add_argument('--locations', help='JSON file with a list of {"name", "lat", "lon"} locations (default: OPENWEATHER_LATITUDE/LONGITUDE)')
+parser.add_argument('--workers', type=int, default=8, help='concurrent API requests')
+parser.add_argument('--calls_per_minute', type=float, default=60, help='API quota')
+parser.add_argument('--full_scan', action='store_true', help='list every compacted file instead of only those after the manifest checkpoint')
+add_metrics_arguments(parser)
 args = parser.parse_args()
+start_run('openweather', args)
+
+warehouse = BigQueryWarehouse(get_bigquery_client(service_account_creds), project_id, dataset)
+
+
+def read_locations() -> list:
+
+    if args.locations is None:
+        return [{'name': None, 'lat': query_params['lat'], 'lon': query_params['lon']}]
+
+    with open(args.locations, 'r') as f:
+        return json.load(f)
+
+
+def fetch_location(session:requests.Session, rate_limiter:TokenBucket, api_key:str, location:dict) -> dict:
+
+    base_url = 'https://api.openweathermap.org/data/2.5/weather'
+    params = {**query_params, 'lat': location['lat'], 'lon': location['lon'], 'api_key': api_key}
+    json_data = get_with_retry(session, base_url, params=params, rate_limiter=rate_limiter).json()
+    if location['name'] is not None:
+        json_data['location'] = location['name']
+    return json_data
+
+
+def fetch_weather() -> pd.DataFrame:
+
+    with open(query_params['api_key'], 'r') as f:
+        api_key:str = f.readline()
+
+    # All locations share one pooled session and the per-minute quota
+    locations:list = read_locations()
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=args.workers))
+    rate_limiter = TokenBucket(rate=args.calls_per_minute / 60)
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(fetch_location, session, rate_limiter, api_key, location) for location in locations]
+
+    json_data:list = []
+    for location, future in zip(locations, futures):
+        try:
+            json_data.append(future.result())
+        except requests.RequestException as e:
+            increment('failed_locations')
+            log(f'Failed to fetch {location["name"] or (location["lat"], location["lon"])}: {e}', level='WARNING')
+    if not json_data:
+        raise RuntimeError('failed to fetch weather data for all locations')
+
+    with phase('parse'):
+        df = pd.json_normalize(json_data)
+    increment('rows', df.shape[0])
+    return df
+
 
 if args.step == "extract":
 
@@ -39,182 +108,152 @@ if args.step == "extract":
 
     # Check if bucket already exists
     bucket = client.lookup_bucket(bucket_name)
-    raw_df_name:str = f'{datetime.now()}__raw_data.csv'
+    raw_df_name:str = f'{datetime.now()}__raw_data.{args.format}'
 
     if bucket is None:
         bucket = client.create_bucket(bucket_name)
-        print(f'Bucket {bucket.name} created.')
-
-    blobs = bucket.list_blobs(prefix=f'{raw_folder_name}/')
-    blobs_list = [blob.name for blob in blobs]
+        log(f'Bucket {bucket.name} created.')
 
-    if f'{raw_folder_name}/' not in blobs_list:
+    if not bucket.blob(f'{raw_folder_name}/').exists():
 
         bucket.blob(f'{raw_folder_name}/').upload_from_string('')
-        print(f'{raw_folder_name}/ folder created.')
+        log(f'{raw_folder_name}/ folder created.')
 
     # extract data from API
-    print(f'[INFO] Extracting {datetime.now()} data...')
-
-    with open(query_params['api_key'], 'r') as f:
-        api_key:str = f.readline()
-        query_params['api_key'] = api_key
+    log(f'Extracting {datetime.now()} data...')
+    raw_df:pd.DataFrame = fetch_weather()
 
-    base_url = 'https://api.openweathermap.org/data/2.5/weather'
-    url = base_url + '?'
-    for param in query_params:
-        url += f'{param}={query_params[param]}'
-        if param == list(query_params.keys())[-1]:
-            continue
-        else:
-            url += '&'
-    
-    response = requests.get(url)
-    json_data = response.json()
-    raw_df:pd.DataFrame = pd.json_normalize(json_data)
-
-    # save raw df to GCS
+    # save raw df to GCS; all locations of the run go to one object
     blob = bucket.blob(f'{raw_folder_name}/{raw_df_name}')
-    blob.upload_from_string(raw_df.to_csv(index=False), 'text/csv')
-    print(f'[INFO] Done saving {raw_df_name} to GCS bucket.')
+    upload_bytes(blob, serialize(raw_df, args.format), CONTENT_TYPES[args.format])
+    log(f'Done saving {raw_df_name} to GCS bucket.')
+
+
+def compact_day(bucket:storage.Bucket, day:str, blobs:list) -> int:
+
+    # A previous run may have died after writing the day's file but before deleting all
+    # of its snapshots, so the existing file is merged in as well
+    compacted_name = f'{compacted_folder_name}/{day}__raw_data.parquet'
+    dfs:list = []
+    compacted_blob = bucket.get_blob(compacted_name)
+    if compacted_blob is not None:
+        dfs.append(normalize_weather(deserialize(download_bytes(compacted_blob), 'parquet')))
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        dfs.extend(executor.map(lambda blob: normalize_weather(deserialize(download_bytes(blob), blob.name.split('.')[-1])), blobs))
+
+    # Runs can return the same observation again; `dt` is its time and the coordinates its location
+    with phase('compact'):
+        df = pd.concat(dfs, ignore_index=True).drop_duplicates(subset=['coord.lat', 'coord.lon', 'dt'], keep='last')
+        df = df.sort_values('dt', ignore_index=True)
+    increment('rows', df.shape[0])
+    upload_bytes(bucket.blob(compacted_name), serialize(df, 'parquet'), CONTENT_TYPES['parquet'])
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(lambda blob: blob.delete(), blobs))
+    return df.shape[0]
+
+
+if args.step == "compact":
+
+    client = storage.Client.from_service_account_json(service_account_creds)
+    bucket = client.lookup_bucket(bucket_name)
+
+    # Raw snapshots are named after the local time of the run, so today's are still being written
+    today:str = datetime.now().strftime('%Y-%m-%d')
+    snapshots:dict = {}
+    for blob in bucket.list_blobs(prefix=f'{raw_folder_name}/', end_offset=f'{raw_folder_name}/{today}'):
+        if blob.name != f'{raw_folder_name}/':
+            snapshots.setdefault(blob.name.split('/')[-1][:10], []).append(blob)
+
+    log(f'{len(snapshots)} days to compact.')
+
+    # Recorded up front, since a rerun after a failure rewrites days the transform may already have passed
+    record_pending(bucket, f'{pending_folder_name}/', [f'{compacted_folder_name}/{day}__raw_data.parquet' for day in snapshots])
+    for day, blobs in sorted(snapshots.items()):
+        num_rows = compact_day(bucket, day, blobs)
+        log(f'Compacted {len(blobs)} snapshots of {day} into {num_rows} rows.')
+
 
-'''
 if args.step == "transform":
 
     # Create a storage client
     client = storage.Client.from_service_account_json(service_account_creds)
 
     bucket = client.lookup_bucket(bucket_name)
-    blobs = bucket.list_blobs(prefix=f'{transformed_folder_name}/')
-    blobs_list = [blob.name for blob in blobs]
-
-    if f'{transformed_folder_name}/' not in blobs_list:
+    if not bucket.blob(f'{transformed_folder_name}/').exists():
 
         bucket.blob(f'{transformed_folder_name}/').upload_from_string('')
-        print(f'{transformed_folder_name}/ folder created.')
+        log(f'{transformed_folder_name}/ folder created.')
+
+    # Compacted files hold one finished day each, so they're transformed instead of the raw snapshots
+    manifest = read_json_blob(bucket, transform_manifest_name) or {'checkpoint': '', 'processed': {}}
+    compacted_blobs, pending_markers = list_unprocessed_blobs(bucket, f'{compacted_folder_name}/', manifest, f'{pending_folder_name}/', full_scan=args.full_scan)
+    log(f'{len(compacted_blobs)} new compacted files since {manifest["checkpoint"] or "the first run"}.')
+    for blob in compacted_blobs:
 
-    raw_blobs = bucket.list_blobs(prefix=f'{raw_folder_name}/')
-    raw_blobs_list = [
-        blob.name for blob in raw_blobs if blob.name != f'{raw_folder_name}/'
-    ]
-    for filename in raw_blobs_list:
+        day = blob.name.split('/')[-1][:10]
+        transformed_df_name = f'{day}__transformed_data.{args.format}'
+        raw_df = deserialize(download_bytes(blob), 'parquet')
 
-        day = filename.split('/')[-1][:10]
-        transformed_df_name = f'{day}__transformed_data.csv'
-        if f'{transformed_folder_name}/{transformed_df_name}' in blobs_list:
-            print(f'[INFO] {transformed_df_name} already in GCS bucket. Skipping.')
-        
-        else:
-            blob = bucket.get_blob(filename)
-            data = blob.download_as_text()
-            raw_df = pd.read_csv(StringIO(data))
+        with phase('transform'):
+            transformed_df = transform_openweather(raw_df)
+        increment('rows', transformed_df.shape[0])
 
-            transformed_df = transform(raw_df)
+        # save transformed df to GCS
+        transformed_blob = bucket.blob(f'{transformed_folder_name}/{transformed_df_name}')
+        upload_bytes(transformed_blob, serialize(transformed_df, args.format), CONTENT_TYPES[args.format])
+        log(f'Done saving {transformed_df_name} to GCS bucket.')
 
-            # save transformed df to GCS
-            blob = bucket.blob(f'{transformed_folder_name}/{transformed_df_name}')
-            blob.upload_from_string(transformed_df.to_csv(index=False), 'text/csv')
-            print(f'[INFO] Done saving {transformed_df_name} to GCS bucket.')      
+        mark_processed(manifest, blob)
+        write_json_blob(bucket, transform_manifest_name, manifest)
+
+    for marker in pending_markers:
+        marker.delete()
 
 
 if args.step == "load":
 
-    credentials = service_account.Credentials.from_service_account_file(service_account_creds)
-    pandas_gbq.context.credentials = credentials
+    bucket = get_bucket(get_storage_client(service_account_creds), bucket_name)
 
-    # Create a storage client
-    client = storage.Client.from_service_account_json(service_account_creds)
+    # Loaded days are tracked in a state file in the bucket. Rows appended by `--step all`
+    # aren't in it, so a table should be fed by one of the two modes only
+    load_state = read_json_blob(bucket, load_state_name) or {'ingested_days': []}
+    ingested_days = set(load_state['ingested_days'])
 
-    bucket = client.lookup_bucket(bucket_name)
     blobs = bucket.list_blobs(prefix=f'{transformed_folder_name}/')
-    blobs_list = [blob.name for blob in blobs if blob.name != f'{transformed_folder_name}/']
-
-    # Create a bigquery client
-    gbq_client = bigquery.Client.from_service_account_json(service_account_creds)
-    datasets = list(gbq_client.list_datasets())
-    dataset_list = [dataset.dataset_id for dataset in datasets]
-    if dataset not in dataset_list:
-        gbq_client.create_dataset(bigquery.Dataset(gbq_client.dataset(dataset)))
-    
-    tables = list(gbq_client.list_tables(dataset))
-    table_list = [table.table_id for table in tables]
-    if table not in table_list:
-        gbq_client.create_table(bigquery.Table(f'{project_id}.{dataset}.{table}'))
-
-    table_ref = gbq_client.dataset(dataset).table(table)
-    if gbq_client.get_table(table_ref).num_rows > 0:
-        query = f"""
-            SELECT DISTINCT
-                DATE(created_at) AS day
-            FROM {dataset}.{table}
-        """
-        query_job = gbq_client.query(query)
-        ingested_days = [row.day.strftime('%Y-%m-%d') for row in query_job]
-    else:
-        ingested_days = []
-
-    for filename in blobs_list:
-        blob = bucket.get_blob(filename)
-        data = blob.download_as_text()
-        transformed_df = pd.read_csv(StringIO(data))
-        day = filename.split('/')[-1][:10]
+    for blob in [blob for blob in blobs if blob.name != f'{transformed_folder_name}/']:
+        day = blob.name.split('/')[-1][:10]
         if day in ingested_days:
-            print(f'[INFO] {day} data already ingested to GBQ. Skipping.')
-        else:
-            print(f'[INFO] Ingesting {day} data to GBQ...')
-            transformed_df.to_gbq(
-                destination_table=f'{dataset}.{table}',
-                project_id=project_id,
-                if_exists='append'
-            )  
-
-
-def transform(df:pd.DataFrame) -> pd.DataFrame:
-
-    drop_columns = [
-        'type',
-        'properties.ids', 
-        'properties.sources', 
-        'properties.types'
-    ]
-    df.drop(columns=drop_columns, inplace=True)
-
-    columns_mapping = {
-        'properties.mag': 'magnitude',
-        'properties.place': 'place',
-        'properties.time': 'created_at',
-        'properties.updated': 'updated_at',
-        'properties.tz': 'timezone',
-        'properties.url': 'url',
-        'properties.detail': 'detail',
-        'properties.felt': 'felt',
-        'properties.cdi': 'cdi',
-        'properties.mmi': 'mmi',
-        'properties.alert': 'alert',
-        'properties.status': 'status',
-        'properties.tsunami': 'tsunami',
-        'properties.sig': 'sig',
-        'properties.net': 'net',
-        'properties.code': 'code',
-        'properties.nst': 'nst',
-        'properties.dmin': 'dmin',
-        'properties.rms': 'rms',
-        'properties.gap': 'gap',
-        'properties.magType': 'magnitude_type',
-        'properties.type': 'type',
-        'properties.title': 'title',
-        'geometry.type': 'geometry_type'
-    }
-    df.rename(columns=columns_mapping, inplace=True)
-
-    df[['longitude', 'latitude', 'depth']] = df['geometry.coordinates'].apply(
-        lambda x: pd.Series(eval(x))
-    )
-    
-    df.drop(columns=['geometry.coordinates'], inplace=True)
-
-    df['created_at'] = pd.to_datetime(df['created_at'], unit='ms', utc=True).dt.strftime('%Y-%m-%d %H:%M:%S')
-    df['updated_at'] = pd.to_datetime(df['updated_at'], unit='ms', utc=True).dt.strftime('%Y-%m-%d %H:%M:%S')
+            log(f'{day} data already ingested to GBQ. Skipping.')
+            continue
 
-    return df
-'''
\ No newline at end of file
+        transformed_df = deserialize(download_bytes(blob), blob.name.split('.')[-1])
+        log(f'Ingesting {day} data to GBQ...')
+        with phase('load_job'):
+            increment('rows_loaded', warehouse.append(table, transformed_df))
+
+        ingested_days.add(day)
+        load_state['ingested_days'] = sorted(ingested_days)
+        write_json_blob(bucket, load_state_name, load_state)
+
+
+if args.step == "all":
+
+    # extract -> transform -> load in one process, passing the DataFrames in memory
+    log(f'Extracting {datetime.now()} data...')
+    raw_df:pd.DataFrame = fetch_weather()
+
+    if args.archive_raw:
+        bucket = get_bucket(get_storage_client(service_account_creds), bucket_name)
+        raw_df_name:str = f'{raw_folder_name}/{datetime.now()}__raw_data.{args.format}'
+        upload_bytes(bucket.blob(raw_df_name), serialize(raw_df, args.format), CONTENT_TYPES[args.format])
+        log(f'Archived raw data to {raw_df_name}.')
+
+    with phase('transform'):
+        df = transform_openweather(raw_df)
+
+    log(f'Ingesting {df.shape[0]} rows to GBQ...')
+    with phase('load_job'):
+        increment('rows_loaded', warehouse.append(table, df))
+    log(f'Done ingesting data to GBQ.')
@@ -1,12 +1,18 @@
 import argparse
+import hashlib
 import requests
+import numpy as np
 import pandas as pd
-import pandas_gbq
-from google.cloud import storage, bigquery
-from io import StringIO
-from google.oauth2 import service_account
+from google.cloud import storage
 import os
 from dotenv import load_dotenv
+from datetime import datetime
+from io import BytesIO
+from utils import FILE_FORMATS, CONTENT_TYPES, get_with_retry, serialize, deserialize, upload_bytes, download_bytes
+from transforms import transform_ph_news
+from pipeline import get_storage_client, get_bigquery_client, get_bucket
+from backends import BACKENDS, LocalStorageClient, SQLiteWarehouse, BigQueryWarehouse
+from metrics import add_metrics_arguments, start_run, log, phase, increment
 
 
 
@@ -18,6 +24,8 @@ dataset = os.getenv("RAW_DATASET")
 bucket_name = os.getenv("PH_NEWS_BUCKET")
 raw_folder_name = 'data/raw'
 transformed_folder_name = 'data/transformed'
+url_index_name = 'data/url_index.parquet'
+pending_url_index_name = 'data/url_index_pending.parquet'
 dataset = os.getenv("RAW_DATASET")
 table = os.getenv("PH_NEWS_TABLE")
 min_date = '2023-06-01 00:00:00+08:00'
@@ -31,37 +39,126 @@ query_params = {
 
 # Parse command line arguments
 parser = argparse.ArgumentParser(prog='PH News ETL')
-parser.add_argument('--step', action='store', required=True, choices=['extract', 'transform', 'load'])
+parser.add_argument('--step', action='store', required=True, choices=['extract', 'transform', 'load', 'all'])
+parser.add_argument('--format', default='csv', choices=FILE_FORMATS, help='file format of the raw/transformed files')
+parser.add_argument('--archive_raw', action='store_true', help='with --step all, also save the new raw articles to the bucket')
+parser.add_argument('--max_pages', type=int, default=10, help='max pages of 100 articles to fetch per run')
+parser.add_argument('--url_index_retention_days', type=int, default=30, help='days to keep URL hashes in the dedup index')
+parser.add_argument('--backend', default='cloud', choices=BACKENDS, help='local: keep the files in a folder and load into SQLite, both under --local_dir')
+parser.add_argument('--local_dir', default='local_data', help='root folder of the local backend')
+add_metrics_arguments(parser)
 args = parser.parse_args()
+start_run('ph_news', args)
 
+if args.backend == 'local':
+    client = LocalStorageClient(os.path.join(args.local_dir, 'storage'))
+    warehouse = SQLiteWarehouse(os.path.join(args.local_dir, 'warehouse.db'))
+else:
+    client = get_storage_client(service_account_creds)
+    warehouse = BigQueryWarehouse(get_bigquery_client(service_account_creds), project_id, dataset)
 
-def convert_timezone(ts, target_tz):
-    if ts.tzinfo is None:
-        return ts.tz_localize('UTC').tz_convert(target_tz)
-    else:
-        return ts.tz_convert(target_tz)
 
+def hash_urls(urls) -> np.ndarray:
+
+    # 8-byte keys keep the index compact (~8 bytes per article) and fixed-width
+    return np.array([
+        int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+        for url in urls
+    ], dtype=np.int64)
+
+
+def read_url_index(bucket:storage.Bucket) -> pd.DataFrame:
+
+    blob = bucket.get_blob(url_index_name)
+    if blob is not None:
+        return pd.read_parquet(BytesIO(download_bytes(blob)))
+
+    # First run with the index: seed it from the batch the previous runs deduplicated against
+    urls:list = []
+    latest_batch = bucket.get_blob(f'{raw_folder_name}/latest_batch.{args.format}')
+    if latest_batch is not None:
+        urls = deserialize(download_bytes(latest_batch), args.format)['url'].tolist()
+    return pd.DataFrame({
+        'url_hash': hash_urls(urls),
+        'seen_at': pd.Series(pd.Timestamp.now(tz='UTC').normalize(), index=range(len(urls)), dtype='datetime64[ns, UTC]')
+    })
+
+
+def write_url_index(bucket:storage.Bucket, url_index:pd.DataFrame, name:str) -> None:
+
+    # Compaction: articles are fetched newest first, so hashes older than the
+    # retention window can't be met again before pagination stops
+    cutoff = pd.Timestamp.now(tz='UTC').normalize() - pd.Timedelta(days=args.url_index_retention_days)
+    url_index = url_index[url_index['seen_at'] >= cutoff].drop_duplicates('url_hash', keep='last')
+
+    buffer = BytesIO()
+    url_index.to_parquet(buffer, index=False, compression='zstd')
+    upload_bytes(bucket.blob(name), buffer.getvalue(), CONTENT_TYPES['parquet'])
 
-if args.step == "extract":
+
+def promote_url_index(bucket:storage.Bucket) -> None:
+
+    # Written by the extract and only made the index once its articles are loaded, so a
+    # failed load doesn't mark them as seen
+    pending_index = bucket.get_blob(pending_url_index_name)
+    if pending_index is not None:
+        bucket.copy_blob(pending_index, bucket, url_index_name)
+        pending_index.delete()
+        log('Saved URL index.')
+
+
+def fetch_news(seen_hashes:set) -> pd.DataFrame:
 
     with open(query_params['access_key'], 'r') as f:
         api_key:str = f.readline()
-        query_params['access_key'] = api_key
 
+    # Results are sorted newest first, so page through them until reaching an article
+    # seen by a previous run (or the end of the results)
     url:str = 'http://api.mediastack.com/v1/news'
-    response = requests.get(url, params=query_params)
-    data:list = response.json()['data']
-    df:pd.DataFrame = pd.json_normalize(data)
+    data:list = []
+    with requests.Session() as session:
+        for page in range(args.max_pages):
+            params:dict = {**query_params, 'access_key': api_key, 'offset': page * query_params['limit']}
+            page_data:list = get_with_retry(session, url, params=params).json()['data']
+            data.extend(page_data)
+            if len(page_data) < query_params['limit']:
+                break
+            if seen_hashes.intersection(hash_urls(article['url'] for article in page_data).tolist()):
+                break
+        else:
+            log(f'Stopped after {args.max_pages} pages without reaching already-seen articles.', level='WARNING')
+
+    with phase('parse'):
+        df = pd.json_normalize(data)
+    increment('rows', df.shape[0])
+    return df
+
+
+def get_new_articles(url_index:pd.DataFrame, df:pd.DataFrame) -> tuple:
+
+    # Returns the new articles and the updated index, which is saved by the caller
+    if df.shape[0] == 0:
+        return df, url_index
+
+    # Articles whose URL is already in the index were ingested by a previous run
+    url_hashes:np.ndarray = hash_urls(df['url'])
+    is_new:np.ndarray = ~np.isin(url_hashes, url_index['url_hash'].to_numpy()) & ~pd.Series(url_hashes).duplicated().to_numpy()
+    df_new:pd.DataFrame = df[is_new]
+
+    # Re-add every fetched hash so articles still being served don't age out of the index
+    seen_at = pd.Timestamp.now(tz='UTC').normalize()
+    url_index = pd.concat([url_index, pd.DataFrame({'url_hash': url_hashes, 'seen_at': seen_at})], ignore_index=True)
+    return df_new, url_index
 
-    # Create a storage client
-    client = storage.Client.from_service_account_json(service_account_creds)
+
+if args.step == "extract":
 
     # Check if bucket already exists
     bucket = client.lookup_bucket(str(bucket_name))
 
     if bucket is None:
         bucket = client.create_bucket(bucket_name)
-        print(f'Bucket {bucket.name} created.')
+        log(f'Bucket {bucket.name} created.')
 
     blobs = bucket.list_blobs(prefix=f'{raw_folder_name}/')
     blobs_list = [blob.name for blob in blobs]
@@ -69,90 +166,85 @@ if args.step == "extract":
     if f'{raw_folder_name}/' not in blobs_list:
 
         bucket.blob(f'{raw_folder_name}/').upload_from_string('')
-        print(f'{raw_folder_name}/ folder created.')
+        log(f'{raw_folder_name}/ folder created.')
 
-    latest_batch:str = 'latest_batch.csv'
-    new_data:str = 'new_data.csv'
-    if bucket is None:
-        bucket = client.create_bucket(bucket_name)
-        print(f'Bucket {bucket.name} created.')
-        df_new:pd.DataFrame = df
-    else:
-        blob = bucket.blob(f'{raw_folder_name}/{latest_batch}')
-        if blob.exists():
-            data_blob = bucket.get_blob(f'{raw_folder_name}/{latest_batch}')
-            data_str = data_blob.download_as_string()
-            data_file = StringIO(data_str.decode('utf-8'))
-            df_prev:pd.DataFrame = pd.read_csv(data_file)
-            df_new:pd.DataFrame = df[~df['url'].isin(df_prev['url'])]
-        else:
-            df_new:pd.DataFrame = df
-    
-    bucket.blob(f'{raw_folder_name}/{latest_batch}').upload_from_string(df.to_csv(index=False), 'text/csv')
-    bucket.blob(f'{raw_folder_name}/{new_data}').upload_from_string(df_new.to_csv(index=False), 'text/csv')
+    url_index:pd.DataFrame = read_url_index(bucket)
+    df:pd.DataFrame = fetch_news(set(url_index['url_hash'].tolist()))
 
+    new_data:str = f'new_data.{args.format}'
+    df_new, url_index = get_new_articles(url_index, df)
+    upload_bytes(bucket.blob(f'{raw_folder_name}/{new_data}'), serialize(df_new, args.format), CONTENT_TYPES[args.format])
+    # promoted to the index by the load step once the new articles are in the table
+    write_url_index(bucket, url_index, pending_url_index_name)
+    log(f'Fetched {df.shape[0]} articles, {df_new.shape[0]} new.')
 
 
 
-if args.step == "transform":
 
-    # Create a storage client
-    client = storage.Client.from_service_account_json(service_account_creds)
+if args.step == "transform":
 
     bucket = client.get_bucket(bucket_name)
-    data_blob = bucket.get_blob(f'{raw_folder_name}/new_data.csv')
-    data_str = data_blob.download_as_string()
-    data_file = StringIO(data_str.decode('utf-8'))
-    df = pd.read_csv(data_file)
+    data_blob = bucket.get_blob(f'{raw_folder_name}/new_data.{args.format}')
+    df = deserialize(download_bytes(data_blob), args.format)
 
-    if df.shape[0] > 0:
+    with phase('transform'):
+        df = transform_ph_news(df, min_date)
+    increment('rows', df.shape[0])
 
-        # data cleaning and filtering
-        df.drop(columns=['language', 'country'], inplace=True)
+    df_transformed_name:str = f'{transformed_folder_name}/df_transformed.{args.format}'
+    blob = bucket.blob(df_transformed_name)
+    blob.metadata = {'num_rows': str(df.shape[0])}
+    upload_bytes(blob, serialize(df, args.format), CONTENT_TYPES[args.format])
 
-        df['published_at'] = pd.to_datetime(df['published_at'], errors='coerce')
-        df['published_at'] = df['published_at'].apply(lambda x: convert_timezone(x, 'Asia/Manila'))
-        df.dropna(subset=['published_at'], inplace=True)
 
-        df = df[df['published_at'] >= min_date] # only relevant for the first couple of runs
-    
-    df_transformed_name:str = f'{transformed_folder_name}/df_transformed.csv'
-    bucket.blob(df_transformed_name).upload_from_string(df.to_csv(index=False), 'text/csv')
 
 
+if args.step == "load":
 
+    bucket = client.get_bucket(bucket_name)
+    df_transformed_name:str = f'{transformed_folder_name}/df_transformed.{args.format}'
+    data_blob = bucket.get_blob(df_transformed_name)
+    # the row count is recorded on the blob, so the file is only read by the load itself
+    num_rows = int((data_blob.metadata or {}).get('num_rows', -1))
+
+    if num_rows == 0:
+        log('No new rows to be ingested.')
+        promote_url_index(bucket)
+        exit(0)
 
-if args.step == "load":
+    log(f'Ingesting new data to {table}...')
+    with phase('load_job'):
+        increment('rows_loaded', warehouse.append_blob(table, data_blob, args.format))
+    log(f'Done ingesting new data to {table}.')
+    promote_url_index(bucket)
 
-    credentials = service_account.Credentials.from_service_account_file(service_account_creds)
-    pandas_gbq.context.credentials = credentials
 
-    # Create a storage client
-    client = storage.Client.from_service_account_json(service_account_creds)
 
-    bucket = client.get_bucket(bucket_name)
-    data_blob = bucket.get_blob(f'{transformed_folder_name}/df_transformed.csv')
-    data_str = data_blob.download_as_string()
-    data_file = StringIO(data_str.decode('utf-8'))
-    df = pd.read_csv(data_file)
 
+if args.step == "all":
+
+    # extract -> transform -> load in one process, passing the DataFrames in memory
+    bucket = get_bucket(client, bucket_name)
+
+    log(f'Extracting news...')
+    url_index:pd.DataFrame = read_url_index(bucket)
+    df_new, url_index = get_new_articles(url_index, fetch_news(set(url_index['url_hash'].tolist())))
+    if args.archive_raw:
+        raw_df_name:str = f'{raw_folder_name}/{datetime.now()}__raw_data.{args.format}'
+        upload_bytes(bucket.blob(raw_df_name), serialize(df_new, args.format), CONTENT_TYPES[args.format])
+        log(f'Archived raw data to {raw_df_name}.')
+
+    with phase('transform'):
+        df = transform_ph_news(df_new.copy(), min_date)
     if df.shape[0] == 0:
-        print('[INFO] No new rows to be ingested.')
+        log('No new rows to be ingested.')
+        write_url_index(bucket, url_index, url_index_name)
         exit(0)
 
-    # Create a bigquery client
-    gbq_client = bigquery.Client.from_service_account_json(service_account_creds)
-    datasets = list(gbq_client.list_datasets())
-    dataset_list = [dataset.dataset_id for dataset in datasets]
-    if dataset not in dataset_list:
-        gbq_client.create_dataset(bigquery.Dataset(gbq_client.dataset(dataset)))
-    
-    tables = list(gbq_client.list_tables(dataset))
-    table_list = [table.table_id for table in tables]
-
-    if table not in table_list:
-        gbq_client.create_table(bigquery.Table(f'{project_id}.{dataset}.{table}'))
-
-    print(f'[INFO] Ingesting new data to GBQ...')
-    df.to_gbq(destination_table=f'{dataset}.{table}', project_id=project_id, if_exists='append')
-    print(f'[INFO] Done ingesting new data to GBQ.')    
+    log(f'Ingesting {df.shape[0]} new rows to {table}...')
+    with phase('load_job'):
+        increment('rows_loaded', warehouse.append(table, df))
+    log(f'Done ingesting new data to {table}.')
+
+    # only saved once the articles are in the table, so a failed load fetches them again
+    write_url_index(bucket, url_index, url_index_name)
@@ -0,0 +1,30 @@
+import functools
+from google.cloud import storage, bigquery
+from metrics import log
+
+
+
+
+# Shared helpers for running extract -> transform -> load in a single process
+# (`--step all`), where DataFrames are passed between the steps in memory and
+# the GCP clients are created once
+
+
+@functools.lru_cache(maxsize=None)
+def get_storage_client(service_account_creds:str) -> storage.Client:
+    return storage.Client.from_service_account_json(service_account_creds)
+
+
+@functools.lru_cache(maxsize=None)
+def get_bigquery_client(service_account_creds:str) -> bigquery.Client:
+    return bigquery.Client.from_service_account_json(service_account_creds)
+
+
+def get_bucket(client:storage.Client, bucket_name:str) -> storage.Bucket:
+
+    # Check if bucket already exists
+    bucket = client.lookup_bucket(bucket_name)
+    if bucket is None:
+        bucket = client.create_bucket(bucket_name)
+        log(f'Bucket {bucket.name} created.')
+    return bucket
@@ -0,0 +1,141 @@
+import ast
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+
+
+def split_coordinates(coordinates:pd.Series) -> np.ndarray:
+
+    # [longitude, latitude, depth] lists are kept as arrays when read from the GeoJSON or
+    # parquet, but become "[lon, lat, depth]" strings after a CSV round-trip
+    if pd.api.types.is_string_dtype(coordinates):
+        return coordinates.str.strip('[]').str.split(',', expand=True).astype(float).to_numpy()
+
+    return np.array(coordinates.tolist(), dtype=float)
+
+
+def transform_usgs_earthquake(df:pd.DataFrame) -> pd.DataFrame:
+
+    drop_columns = [
+        'type',
+        'properties.ids', 
+        'properties.sources', 
+        'properties.types'
+    ]
+    df.drop(columns=drop_columns, inplace=True)
+
+    columns_mapping = {
+        'properties.mag': 'magnitude',
+        'properties.place': 'place',
+        'properties.time': 'created_at',
+        'properties.updated': 'updated_at',
+        'properties.tz': 'timezone',
+        'properties.url': 'url',
+        'properties.detail': 'detail',
+        'properties.felt': 'felt',
+        'properties.cdi': 'cdi',
+        'properties.mmi': 'mmi',
+        'properties.alert': 'alert',
+        'properties.status': 'status',
+        'properties.tsunami': 'tsunami',
+        'properties.sig': 'sig',
+        'properties.net': 'net',
+        'properties.code': 'code',
+        'properties.nst': 'nst',
+        'properties.dmin': 'dmin',
+        'properties.rms': 'rms',
+        'properties.gap': 'gap',
+        'properties.magType': 'magnitude_type',
+        'properties.type': 'type',
+        'properties.title': 'title',
+        'geometry.type': 'geometry_type'
+    }
+    df.rename(columns=columns_mapping, inplace=True)
+
+    df[['longitude', 'latitude', 'depth']] = split_coordinates(df.pop('geometry.coordinates'))
+
+    # epoch milliseconds are already UTC; formatting tz-naive datetimes is much faster than tz-aware ones
+    df['created_at'] = pd.to_datetime(df['created_at'], unit='ms').dt.strftime('%Y-%m-%d %H:%M:%S')
+    df['updated_at'] = pd.to_datetime(df['updated_at'], unit='ms').dt.strftime('%Y-%m-%d %H:%M:%S')
+
+    return df
+
+
+def convert_timezone(ts, target_tz):
+    if ts.tzinfo is None:
+        return ts.tz_localize('UTC').tz_convert(target_tz)
+    else:
+        return ts.tz_convert(target_tz)
+
+
+def normalize_timezone(timestamps:pd.Series, target_tz:str) -> pd.Series:
+
+    # Vectorized convert_timezone: parses mixed-offset strings to UTC in one pass (naive
+    # timestamps are taken as UTC) and converts the whole column; unparseable values become NaT
+    return pd.to_datetime(timestamps, utc=True, errors='coerce', format='ISO8601').dt.tz_convert(target_tz)
+
+
+def transform_ph_news(df:pd.DataFrame, min_date:str) -> pd.DataFrame:
+
+    if df.shape[0] > 0:
+
+        # data cleaning and filtering
+        df.drop(columns=['language', 'country'], inplace=True)
+
+        df['published_at'] = normalize_timezone(df['published_at'], 'Asia/Manila')
+        df.dropna(subset=['published_at'], inplace=True)
+
+        df = df[df['published_at'] >= min_date] # only relevant for the first couple of runs
+
+    return df
+
+
+def normalize_weather(df:pd.DataFrame) -> pd.DataFrame:
+
+    # `weather` is a list of condition objects: API responses and raw parquet snapshots
+    # have it as a list or an array of dicts, raw CSV snapshots as the list's repr and
+    # compacted files as JSON, so every value is turned into a JSON string (pyarrow can't
+    # write a column mixing arrays and strings)
+    def to_json(value):
+        if isinstance(value, str):
+            try:
+                return json.dumps(json.loads(value))
+            except json.JSONDecodeError:
+                value = ast.literal_eval(value)
+        elif isinstance(value, np.ndarray):
+            value = value.tolist()
+        return json.dumps(value) if isinstance(value, list) else value
+
+    if 'weather' in df.columns:
+        df['weather'] = df['weather'].map(to_json)
+    return df
+
+
+def transform_openweather(df:pd.DataFrame) -> pd.DataFrame:
+
+    # BigQuery column names can't contain dots
+    df = df.rename(columns=lambda col: col.replace('.', '_'))
+    return normalize_weather(df)
+
+
+def hash_row(row:list) -> str:
+    return hashlib.blake2b('\x1f'.join(row).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def diff_snapshot(values:list, previous_hashes:dict, parse_row) -> tuple:
+
+    # `values` are the sheet's raw values (header row first). Every row is hashed into the
+    # new snapshot, keyed by id, and only the rows whose hash changed since `previous_hashes`
+    # are parsed into the DataFrame; parse_row is gspread's numericise_all in the pipeline, so
+    # the values come out the same as with get_all_records()
+    header, rows = values[0], values[1:]
+    id_index:int = header.index('id')
+    snapshot:dict = {row[id_index]: hash_row(row) for row in rows}
+
+    changed_rows = [row for row in rows if previous_hashes.get(row[id_index]) != snapshot[row[id_index]]]
+    inserted_ids = [row[id_index] for row in changed_rows if row[id_index] not in previous_hashes]
+    df = pd.DataFrame([parse_row(row) for row in changed_rows], columns=header)
+    return df, snapshot, inserted_ids
@@ -1,13 +1,15 @@
 import requests
 from datetime import datetime, timedelta, timezone
 import pandas as pd
-import pandas_gbq
 from google.cloud import storage, bigquery
-from io import StringIO
-from google.oauth2 import service_account
 import os
 from dotenv import load_dotenv
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from utils import FILE_FORMATS, CONTENT_TYPES, get_with_retry, serialize, deserialize, read_json_blob, write_json_blob, record_pending, list_unprocessed_blobs, mark_processed, upload_bytes, download_bytes
+from transforms import transform_usgs_earthquake
+from backends import BACKENDS, LocalStorageClient, SQLiteWarehouse, BigQueryWarehouse
+from metrics import add_metrics_arguments, start_run, log, phase, increment
 
 
 
@@ -18,201 +20,178 @@ project_id = os.getenv("PROJECT_ID")
 bucket_name = os.getenv("USGS_EARTHQUAKE_BUCKET")
 raw_folder_name = 'data/raw'
 transformed_folder_name = 'data/transformed'
+load_state_name = 'data/load_state.json'
+transform_manifest_name = 'data/transform_manifest.json'
+pending_folder_name = 'data/pending'
 dataset = os.getenv("RAW_DATASET")
 table = os.getenv("USGS_EARTHQUAKE_TABLE")
+base_url = 'https://earthquake.usgs.gov/fdsnws/event/1/'
 query_params = {
-    'format': 'geojson',
-    'starttime': f'{(datetime.now(timezone.utc).date() + timedelta(days=-1)).strftime("%Y-%m-%d")}',
-    'endtime': f'{datetime.now(timezone.utc).date().strftime("%Y-%m-%d")}'
+    'format': 'geojson'
 }
+yesterday:str = (datetime.now(timezone.utc).date() + timedelta(days=-1)).strftime("%Y-%m-%d")
 
 # Parse command line arguments
 parser = argparse.ArgumentParser(prog='USGS Earthquake ETL')
 parser.add_argument('--step', action='store', required=True, choices=["extract", "transform", "load"])
+parser.add_argument('--format', default='csv', choices=FILE_FORMATS, help='file format of the raw/transformed files')
+parser.add_argument('--start', default=yesterday, help='first day to extract (YYYY-MM-DD); defaults to yesterday')
+parser.add_argument('--end', default=None, help='last day to extract, inclusive (YYYY-MM-DD); defaults to --start')
+parser.add_argument('--workers', type=int, default=8, help='number of days extracted concurrently')
+parser.add_argument('--full_scan', action='store_true', help='list every raw file instead of only those after the manifest checkpoint, e.g. after a backfill')
+parser.add_argument('--backend', default='cloud', choices=BACKENDS, help='local: keep the files in a folder and load into SQLite, both under --local_dir')
+parser.add_argument('--local_dir', default='local_data', help='root folder of the local backend')
+add_metrics_arguments(parser)
 args = parser.parse_args()
+start_run('usgs_earthquake', args)
+
+if args.backend == 'local':
+    client = LocalStorageClient(os.path.join(args.local_dir, 'storage'))
+    warehouse = SQLiteWarehouse(os.path.join(args.local_dir, 'warehouse.db'))
+else:
+    client = storage.Client.from_service_account_json(service_account_creds)
+    warehouse = BigQueryWarehouse(bigquery.Client.from_service_account_json(service_account_creds), project_id, dataset)
+
+
+def fetch_window(session:requests.Session, starttime:datetime, endtime:datetime) -> list:
+
+    # The API rejects queries matching more than `maxAllowed` events, so
+    # bisect the window until each half fits in a single request
+    params = {**query_params, 'starttime': starttime.isoformat(), 'endtime': endtime.isoformat()}
+    count:dict = get_with_retry(session, base_url + 'count', params=params).json()
+    if count['count'] > count['maxAllowed']:
+        midpoint = starttime + (endtime - starttime) / 2
+        log(f'{count["count"]} events between {starttime} and {endtime}; splitting at {midpoint}...')
+        features = fetch_window(session, starttime, midpoint) + fetch_window(session, midpoint, endtime)
+        # both bounds are inclusive, so events exactly at the midpoint are returned twice
+        return list({feature['id']: feature for feature in features}.values())
+
+    return get_with_retry(session, base_url + 'query', params=params).json()['features']
+
+
+def extract_day(session:requests.Session, bucket:storage.Bucket, day:str) -> int:
+
+    # extract data from API
+    log(f'Extracting {day} data...')
+    starttime = datetime.strptime(day, '%Y-%m-%d')
+    json_data = fetch_window(session, starttime, starttime + timedelta(days=1))
+    with phase('parse'):
+        raw_df:pd.DataFrame = pd.json_normalize(json_data)
+    increment('rows', raw_df.shape[0])
+
+    # save raw df to GCS
+    raw_df_name:str = f'{day}__raw_data.{args.format}'
+    blob = bucket.blob(f'{raw_folder_name}/{raw_df_name}')
+    upload_bytes(blob, serialize(raw_df, args.format), CONTENT_TYPES[args.format])
+    log(f'Done saving {raw_df_name} to GCS bucket.')
+
+    return raw_df.shape[0]
 
-client = storage.Client.from_service_account_json(service_account_creds)
-gbq_client = bigquery.Client.from_service_account_json(service_account_creds)
-
-
-def transform(df:pd.DataFrame) -> pd.DataFrame:
-
-    drop_columns = [
-        'type',
-        'properties.ids', 
-        'properties.sources', 
-        'properties.types'
-    ]
-    df.drop(columns=drop_columns, inplace=True)
-
-    columns_mapping = {
-        'properties.mag': 'magnitude',
-        'properties.place': 'place',
-        'properties.time': 'created_at',
-        'properties.updated': 'updated_at',
-        'properties.tz': 'timezone',
-        'properties.url': 'url',
-        'properties.detail': 'detail',
-        'properties.felt': 'felt',
-        'properties.cdi': 'cdi',
-        'properties.mmi': 'mmi',
-        'properties.alert': 'alert',
-        'properties.status': 'status',
-        'properties.tsunami': 'tsunami',
-        'properties.sig': 'sig',
-        'properties.net': 'net',
-        'properties.code': 'code',
-        'properties.nst': 'nst',
-        'properties.dmin': 'dmin',
-        'properties.rms': 'rms',
-        'properties.gap': 'gap',
-        'properties.magType': 'magnitude_type',
-        'properties.type': 'type',
-        'properties.title': 'title',
-        'geometry.type': 'geometry_type'
-    }
-    df.rename(columns=columns_mapping, inplace=True)
-
-    df[['longitude', 'latitude', 'depth']] = df['geometry.coordinates'].apply(
-        lambda x: pd.Series(eval(x))
-    )
-    
-    df.drop(columns=['geometry.coordinates'], inplace=True)
-
-    df['created_at'] = pd.to_datetime(df['created_at'], unit='ms', utc=True).dt.strftime('%Y-%m-%d %H:%M:%S')
-    df['updated_at'] = pd.to_datetime(df['updated_at'], unit='ms', utc=True).dt.strftime('%Y-%m-%d %H:%M:%S')
-
-    return df
-    
 
 if args.step == "extract":
 
     # Check if bucket already exists
     bucket = client.lookup_bucket(bucket_name)
-    raw_df_name:str = f'{query_params["starttime"]}__raw_data.csv'
 
     if bucket is None:
         bucket = client.create_bucket(bucket_name)
-        print(f'Bucket {bucket.name} created.')
+        log(f'Bucket {bucket.name} created.')
 
     blobs = bucket.list_blobs(prefix=f'{raw_folder_name}/')
-    blobs_list = [blob.name for blob in blobs]
+    blobs_list = set(blob.name for blob in blobs)
 
     if f'{raw_folder_name}/' not in blobs_list:
 
         bucket.blob(f'{raw_folder_name}/').upload_from_string('')
-        print(f'{raw_folder_name}/ folder created.')
-
-    elif f'{raw_folder_name}/{raw_df_name}' in blobs_list:
-        print(f'[INFO] {raw_df_name} already in GCS bucket. Skipping.')
-
-        exit(0)
-
-    # extract data from API
-    print(f'[INFO] Extracting {query_params["starttime"]} data...')
-    base_url = 'https://earthquake.usgs.gov/fdsnws/event/1/'
-
-    url = base_url + 'query?'
-    for param in query_params:
-        url += f'{param}={query_params[param]}'
-        if param == list(query_params.keys())[-1]:
-            continue
+        log(f'{raw_folder_name}/ folder created.')
+
+    # One raw file per day so the transform and load steps work the same for backfills
+    days = pd.date_range(args.start, args.end or args.start, freq='D').strftime('%Y-%m-%d').tolist()
+    days_to_extract = []
+    for day in days:
+        if f'{raw_folder_name}/{day}__raw_data.{args.format}' in blobs_list:
+            log(f'{day}__raw_data.{args.format} already in GCS bucket. Skipping.')
         else:
-            url += '&'
-    
-    response = requests.get(url)
-    json_data = response.json()['features']
-    raw_df:pd.DataFrame = pd.json_normalize(json_data)
+            days_to_extract.append(day)
 
-    # save raw df to GCS
-    blob = bucket.blob(f'{raw_folder_name}/{raw_df_name}')
-    blob.upload_from_string(raw_df.to_csv(index=False), 'text/csv')
-    print(f'[INFO] Done saving {raw_df_name} to GCS bucket.')
+    # Recorded up front: a failed run leaves its days missing, so the rerun extracts and records them again
+    record_pending(bucket, f'{pending_folder_name}/', [f'{raw_folder_name}/{day}__raw_data.{args.format}' for day in days_to_extract])
 
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=args.workers))
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        n_events = sum(executor.map(lambda day: extract_day(session, bucket, day), days_to_extract))
+    log(f'Done extracting {n_events} events from {len(days_to_extract)} days.')
 
-if args.step == "transform":
 
-    # Create a storage client
-    client = storage.Client.from_service_account_json(service_account_creds)
+if args.step == "transform":
 
     bucket = client.lookup_bucket(bucket_name)
-    blobs = bucket.list_blobs(prefix=f'{transformed_folder_name}/')
-    blobs_list = [blob.name for blob in blobs]
-
-    if f'{transformed_folder_name}/' not in blobs_list:
+    if not bucket.blob(f'{transformed_folder_name}/').exists():
 
         bucket.blob(f'{transformed_folder_name}/').upload_from_string('')
-        print(f'{transformed_folder_name}/ folder created.')
+        log(f'{transformed_folder_name}/ folder created.')
 
-    raw_blobs = bucket.list_blobs(prefix=f'{raw_folder_name}/')
-    raw_blobs_list = [
-        blob.name for blob in raw_blobs if blob.name != f'{raw_folder_name}/'
-    ]
-    for filename in raw_blobs_list:
+    manifest = read_json_blob(bucket, transform_manifest_name)
+    if manifest is None:
+        # first run with a manifest: raw files that already have a transformed file count as processed
+        manifest = {'checkpoint': '', 'processed': {}}
+        transformed_blobs = set(blob.name for blob in bucket.list_blobs(prefix=f'{transformed_folder_name}/'))
+    else:
+        transformed_blobs = set()
 
-        day = filename.split('/')[-1][:10]
-        transformed_df_name = f'{day}__transformed_data.csv'
-        if f'{transformed_folder_name}/{transformed_df_name}' in blobs_list:
-            print(f'[INFO] {transformed_df_name} already in GCS bucket. Skipping.')
+    raw_blobs, pending_markers = list_unprocessed_blobs(bucket, f'{raw_folder_name}/', manifest, f'{pending_folder_name}/', full_scan=args.full_scan)
+    log(f'{len(raw_blobs)} new raw files since {manifest["checkpoint"] or "the first run"}.')
+    for blob in raw_blobs:
+
+        day = blob.name.split('/')[-1][:10]
+        transformed_df_name = f'{day}__transformed_data.{args.format}'
+        if f'{transformed_folder_name}/{transformed_df_name}' in transformed_blobs:
+            log(f'{transformed_df_name} already in GCS bucket. Skipping.')
         
         else:
-            blob = bucket.get_blob(filename)
-            data = blob.download_as_text()
-            raw_df = pd.read_csv(StringIO(data))
+            raw_df = deserialize(download_bytes(blob), blob.name.split('.')[-1])
 
-            transformed_df = transform(raw_df)
+            with phase('transform'):
+                transformed_df = transform_usgs_earthquake(raw_df)
+            increment('rows', transformed_df.shape[0])
 
             # save transformed df to GCS
-            blob = bucket.blob(f'{transformed_folder_name}/{transformed_df_name}')
-            blob.upload_from_string(transformed_df.to_csv(index=False), 'text/csv')
-            print(f'[INFO] Done saving {transformed_df_name} to GCS bucket.')   
+            transformed_blob = bucket.blob(f'{transformed_folder_name}/{transformed_df_name}')
+            upload_bytes(transformed_blob, serialize(transformed_df, args.format), CONTENT_TYPES[args.format])
+            log(f'Done saving {transformed_df_name} to GCS bucket.')
 
+        mark_processed(manifest, blob)
+        write_json_blob(bucket, transform_manifest_name, manifest)
 
-if args.step == "load":
+    for marker in pending_markers:
+        marker.delete()
 
-    credentials = service_account.Credentials.from_service_account_file(service_account_creds)
-    pandas_gbq.context.credentials = credentials
 
-    # Create a storage client
-    client = storage.Client.from_service_account_json(service_account_creds)
+if args.step == "load":
 
     bucket = client.lookup_bucket(bucket_name)
     blobs = bucket.list_blobs(prefix=f'{transformed_folder_name}/')
     blobs_list = [blob.name for blob in blobs if blob.name != f'{transformed_folder_name}/']
 
-    datasets = list(gbq_client.list_datasets())
-    dataset_list = [dataset.dataset_id for dataset in datasets]
-    if dataset not in dataset_list:
-        gbq_client.create_dataset(bigquery.Dataset(gbq_client.dataset(dataset)))
-    
-    tables = list(gbq_client.list_tables(dataset))
-    table_list = [table.table_id for table in tables]
-    if table not in table_list:
-        gbq_client.create_table(bigquery.Table(f'{project_id}.{dataset}.{table}'))
-
-    table_ref = gbq_client.dataset(dataset).table(table)
-    if gbq_client.get_table(table_ref).num_rows > 0:
-        query = f"""
-            SELECT DISTINCT
-                DATE(created_at) AS day
-            FROM {dataset}.{table}
-        """
-        query_job = gbq_client.query(query)
-        ingested_days = [row.day.strftime('%Y-%m-%d') for row in query_job]
-    else:
-        ingested_days = []
+    # Ingested days are tracked in a state file in the bucket so the table
+    # only has to be scanned once, when the state file doesn't exist yet
+    load_state = read_json_blob(bucket, load_state_name)
+    if load_state is None:
+        load_state = {'ingested_days': sorted(warehouse.distinct_dates(table, 'created_at'))}
+        write_json_blob(bucket, load_state_name, load_state)
+    ingested_days = set(load_state['ingested_days'])
 
     for filename in blobs_list:
-        blob = bucket.get_blob(filename)
-        data = blob.download_as_text()
-        transformed_df = pd.read_csv(StringIO(data))
         day = filename.split('/')[-1][:10]
         if day in ingested_days:
-            print(f'[INFO] {day} data already ingested to GBQ. Skipping.')
-        else:
-            print(f'[INFO] Ingesting {day} data to GBQ...')
-            transformed_df.to_gbq(
-                destination_table=f'{dataset}.{table}',
-                project_id=project_id,
-                if_exists='append'
-            ) 
+            log(f'{day} data already ingested to {table}. Skipping.')
+            continue
+
+        log(f'Ingesting {day} data to {table}...')
+        with phase('load_job'):
+            increment('rows_loaded', warehouse.append_blob(table, bucket.get_blob(filename), filename.split('.')[-1]))
+
+        ingested_days.add(day)
+        load_state['ingested_days'] = sorted(ingested_days)
+        write_json_blob(bucket, load_state_name, load_state)
\ No newline at end of file
@@ -0,0 +1,173 @@
+import json
+import random
+import threading
+import time
+import uuid
+from io import BytesIO
+import pandas as pd
+import requests
+from metrics import log, phase, increment
+
+
+
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+FILE_FORMATS = ['csv', 'parquet']
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet'
+}
+
+
+class TokenBucket:
+    # Thread-safe token bucket; `rate` is in tokens per second
+
+    def __init__(self, rate:float, capacity:int=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def get_with_retry(
+    session:requests.Session,
+    url:str,
+    params:dict=None,
+    rate_limiter:TokenBucket=None,
+    max_retries:int=5,
+    backoff:float=2.0,
+    timeout:float=120
+) -> requests.Response:
+
+    for attempt in range(max_retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+
+        increment('requests')
+        try:
+            with phase('http_fetch'):
+                response = session.get(url, params=params, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == max_retries:
+                raise
+            wait = backoff * 2 ** attempt
+            log(f'Request to {url} failed ({e}); retrying in {wait:.0f}s...', level='WARNING')
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or attempt == max_retries:
+                response.raise_for_status()
+                increment('response_bytes', len(response.content))
+                return response
+            # honor the server's Retry-After header if present
+            retry_after = response.headers.get('Retry-After', '')
+            wait = float(retry_after) if retry_after.isdigit() else backoff * 2 ** attempt
+            log(f'Got HTTP {response.status_code} from {url}; retrying in {wait:.0f}s...', level='WARNING')
+
+        increment('retries')
+        time.sleep(wait + random.uniform(0, 1))
+
+
+def serialize(df:pd.DataFrame, file_format:str) -> bytes:
+
+    with phase('serialize'):
+        if file_format == 'parquet':
+            buffer = BytesIO()
+            df.to_parquet(buffer, index=False, compression='zstd')
+            data = buffer.getvalue()
+        else:
+            data = df.to_csv(index=False).encode('utf-8')
+
+    increment('serialized_bytes', len(data))
+    return data
+
+
+def deserialize(data:bytes, file_format:str) -> pd.DataFrame:
+
+    increment('deserialized_bytes', len(data))
+    with phase('deserialize'):
+        if file_format == 'parquet':
+            return pd.read_parquet(BytesIO(data))
+
+        return pd.read_csv(BytesIO(data))
+
+
+def upload_bytes(blob, data, content_type:str=None) -> None:
+
+    with phase('upload'):
+        blob.upload_from_string(data, content_type)
+    increment('uploaded_bytes', len(data))
+
+
+def download_bytes(blob) -> bytes:
+
+    with phase('download'):
+        data = blob.download_as_bytes()
+    increment('downloaded_bytes', len(data))
+    return data
+
+
+def read_json_blob(bucket, name:str) -> dict:
+
+    # Returns None if the blob doesn't exist yet
+    blob = bucket.get_blob(name)
+    if blob is None:
+        return None
+    return json.loads(download_bytes(blob))
+
+
+def write_json_blob(bucket, name:str, data:dict) -> None:
+
+    upload_bytes(bucket.blob(name), json.dumps(data), 'application/json')
+
+
+def record_pending(bucket, pending_prefix:str, blob_names:list) -> None:
+
+    # Written by the steps that produce a transform's input files: a small marker object
+    # naming the files the run wrote, so the transform also finds backfilled or rewritten
+    # files named before its checkpoint
+    if blob_names:
+        write_json_blob(bucket, f'{pending_prefix}{uuid.uuid4().hex}.json', {'blobs': sorted(blob_names)})
+
+
+def list_unprocessed_blobs(bucket, prefix:str, manifest:dict, pending_prefix:str, full_scan:bool=False) -> tuple:
+
+    # The manifest maps processed blob names to their generation, and its checkpoint is
+    # the greatest processed name. Blob names start with their date, so only names from
+    # the checkpoint onwards need to be listed (re-uploads of those have a new generation);
+    # older files are found through the pending markers of the runs that wrote them.
+    # Returns the blobs and the markers to delete once they are processed
+    start_offset = None if full_scan else (manifest['checkpoint'] or None)
+    blobs = {
+        blob.name: blob for blob in bucket.list_blobs(prefix=prefix, start_offset=start_offset)
+        if blob.name != prefix and manifest['processed'].get(blob.name) != blob.generation
+    }
+
+    markers = [blob for blob in bucket.list_blobs(prefix=pending_prefix) if blob.name != pending_prefix]
+    for marker in markers:
+        for name in json.loads(download_bytes(marker))['blobs']:
+            blob = bucket.get_blob(name)
+            if blob is not None and name not in blobs and manifest['processed'].get(name) != blob.generation:
+                blobs[name] = blob
+
+    return [blobs[name] for name in sorted(blobs)], markers
+
+
+def mark_processed(manifest:dict, blob) -> None:
+
+    # Names before the checkpoint are never listed again, so only the ones from the
+    # checkpoint onwards are kept and the manifest doesn't grow with the history
+    manifest['processed'][blob.name] = blob.generation
+    manifest['checkpoint'] = max(manifest['checkpoint'], blob.name)
+    manifest['processed'] = {name: generation for name, generation in manifest['processed'].items() if name >= manifest['checkpoint']}
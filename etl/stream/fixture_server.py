@@ -0,0 +1,41 @@
+import os
+import glob
+import argparse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+
+
+
+# Stand-in for the USGS feed server: every GET returns the next fixture feed, and the
+# last one is repeated once they run out, so a daemon pointed at it sees events
+# appear, get revised and age out of the feed
+
+parser = argparse.ArgumentParser(prog='USGS feed fixture server')
+parser.add_argument('--port', type=int, default=8000)
+parser.add_argument('--fixtures', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'all_hour_*.geojson'), help='glob of the feeds to serve, in name order')
+args = parser.parse_args()
+
+fixtures = sorted(glob.glob(args.fixtures))
+if not fixtures:
+    print(f'[ERROR] No fixtures match {args.fixtures}.')
+    exit(1)
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    requests_served = 0
+
+    def do_GET(self):
+        fixture = fixtures[min(FeedHandler.requests_served, len(fixtures) - 1)]
+        FeedHandler.requests_served += 1
+        with open(fixture, 'rb') as f:
+            body = f.read()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/geo+json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+print(f'[INFO] Serving {len(fixtures)} fixture feeds on http://localhost:{args.port}/')
+HTTPServer(('localhost', args.port), FeedHandler).serve_forever()
@@ -0,0 +1,161 @@
+import os
+import sys
+import signal
+import asyncio
+import argparse
+import requests
+import pandas as pd
+from datetime import datetime
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'batch'))
+from utils import get_with_retry
+from transforms import transform_usgs_earthquake
+from metrics import run, log
+
+
+
+
+load_dotenv()
+service_account_creds = os.getenv("SERVICE_ACCOUNT_CREDS")
+project_id = os.getenv("PROJECT_ID")
+dataset = os.getenv("RAW_DATASET")
+# Not the batch pipeline's table: every revision of an event is appended here, and the
+# batch load skips the days it finds in its table, so streamed rows would hide those days
+table = os.getenv("USGS_EARTHQUAKE_STREAM_TABLE")
+
+# Parse command line arguments
+parser = argparse.ArgumentParser(prog='USGS Earthquake stream')
+parser.add_argument('--feed_url', default='https://earthquake.usgs.gov/earthquakes/feed/v1.0/summary/all_hour.geojson', help='summary GeoJSON feed to poll')
+parser.add_argument('--poll_interval', type=float, default=60, help='seconds between polls; the feeds are regenerated every minute')
+parser.add_argument('--batch_size', type=int, default=500, help='flush once this many events are buffered')
+parser.add_argument('--flush_interval', type=float, default=300, help='flush buffered events at least this often, in seconds')
+parser.add_argument('--sink', default='bigquery', choices=['bigquery', 'local'], help='where micro-batches are written')
+parser.add_argument('--output_dir', default='data/stream', help='with --sink local, folder for the micro-batch parquet files')
+args = parser.parse_args()
+
+# The daemon has no steps or exit summary, but its log lines share the batch pipelines' format
+run.update({'pipeline': 'usgs_earthquake_stream', 'step': 'stream'})
+
+
+class EventIndex:
+    # Event id -> `updated` time of the last emitted version
+
+    def __init__(self):
+        self.updated = {}
+
+    def diff(self, features:list) -> list:
+
+        # Only new events and revisions of emitted ones are returned. Summary feeds cover a
+        # fixed time window, so events that dropped out of the feed are forgotten
+        changed = [
+            feature for feature in features
+            if self.updated.get(feature['id'], -1) < feature['properties']['updated']
+        ]
+        self.updated = {feature['id']: feature['properties']['updated'] for feature in features}
+        return changed
+
+
+def get_sink():
+
+    if args.sink == 'local':
+        os.makedirs(args.output_dir, exist_ok=True)
+
+        def write_local(df:pd.DataFrame) -> None:
+            df.to_parquet(os.path.join(args.output_dir, f'{datetime.now():%Y-%m-%dT%H%M%S.%f}__events.parquet'), index=False)
+        return write_local
+
+    # Only needed for BigQuery, so the daemon can be run against the fixture server without GCP libraries
+    from google.cloud import bigquery
+    gbq_client = bigquery.Client.from_service_account_json(service_account_creds)
+    gbq_client.create_dataset(bigquery.Dataset(f'{project_id}.{dataset}'), exists_ok=True)
+    job_config = bigquery.LoadJobConfig(
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION]
+    )
+
+    def write_bigquery(df:pd.DataFrame) -> None:
+        gbq_client.load_table_from_dataframe(df, f'{project_id}.{dataset}.{table}', job_config=job_config).result()
+    return write_bigquery
+
+
+class StreamDaemon:
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.index = EventIndex()
+        self.buffer = []
+        self.batch_full = asyncio.Event()
+        self.stopping = asyncio.Event()
+        self.session = requests.Session()
+
+    async def poll(self) -> None:
+
+        while not self.stopping.is_set():
+            try:
+                response = await asyncio.to_thread(get_with_retry, self.session, args.feed_url, max_retries=2)
+                features:list = response.json()['features']
+            except (requests.RequestException, ValueError, KeyError) as e:
+                # a failed poll is retried on the next interval; the index is left as is
+                log(f'Failed to poll {args.feed_url}: {e}', level='WARNING')
+            else:
+                changed:list = self.index.diff(features)
+                if changed:
+                    log(f'{len(changed)} new or updated events out of {len(features)}.')
+                self.buffer.extend(changed)
+                if len(self.buffer) >= args.batch_size:
+                    self.batch_full.set()
+
+            try:
+                await asyncio.wait_for(self.stopping.wait(), timeout=args.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def flush_loop(self) -> None:
+
+        # Flushes when the poller fills a batch or when `flush_interval` has passed, whichever comes first
+        while True:
+            try:
+                await asyncio.wait_for(self.batch_full.wait(), timeout=args.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+            if self.stopping.is_set():
+                return
+
+    async def flush(self) -> None:
+
+        self.batch_full.clear()
+        if not self.buffer:
+            return
+
+        batch, self.buffer = self.buffer, []
+        # a revised event can be buffered more than once before a flush; keep its latest version
+        batch = list({feature['id']: feature for feature in batch}.values())
+        try:
+            df = transform_usgs_earthquake(pd.json_normalize(batch))
+            await asyncio.to_thread(self.sink, df)
+        except Exception as e:
+            # put the events back so they go out with the next flush
+            log(f'Failed to flush {len(batch)} events: {e}', level='ERROR')
+            self.buffer = batch + self.buffer
+            return
+        log(f'Flushed {len(batch)} events.')
+
+    async def run(self) -> None:
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stopping.set)
+
+        log(f'Polling {args.feed_url} every {args.poll_interval:g}s...')
+        flush_task = asyncio.create_task(self.flush_loop())
+        await self.poll()
+
+        # wake the flush loop so it flushes whatever is left and exits
+        self.batch_full.set()
+        await flush_task
+        log('Stopped.')
+
+
+asyncio.run(StreamDaemon(get_sink()).run())
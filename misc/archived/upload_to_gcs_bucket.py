@@ -1,7 +1,12 @@
 import os
+import base64
+import hashlib
+import mimetypes
 from dotenv import load_dotenv
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
+import google_crc32c
 from google.cloud import storage
 
 
@@ -13,11 +18,63 @@ parser = argparse.ArgumentParser()
 parser.add_argument("--upload_file", type=str, help="/file/to/upload")
 parser.add_argument("--name", type=str, help="uploaded file name in GCS bucket")
 parser.add_argument("--bucket_name", type=str, help="GCS bucket name")
+parser.add_argument("--content_type", type=str, help="defaults to the type guessed from the file name")
+parser.add_argument("--parallel_threshold", type=int, default=150, help="files of at least this many MB are uploaded as parallel parts")
+parser.add_argument("--part_size", type=int, default=32, help="part size in MB for parallel uploads")
+parser.add_argument("--workers", type=int, default=8, help="concurrent part uploads")
 args = parser.parse_args()
 
 upload_file = args.upload_file
 name = args.name
 bucket_name = args.bucket_name
+content_type = args.content_type or mimetypes.guess_type(upload_file)[0] or 'application/octet-stream'
+chunk_size = 1024 * 1024
+
+# GCS composes at most 32 objects per request
+max_compose_components = 32
+
+
+def crc32c_of(data:bytes) -> str:
+
+    # GCS reports checksums as base64 of the big-endian digest
+    return base64.b64encode(google_crc32c.Checksum(data).digest()).decode()
+
+
+def hash_file(path:str) -> tuple:
+
+    crc32c = google_crc32c.Checksum()
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            crc32c.update(chunk)
+            md5.update(chunk)
+    return base64.b64encode(crc32c.digest()).decode(), base64.b64encode(md5.digest()).decode()
+
+
+def upload_part(part_number:int) -> storage.Blob:
+
+    with open(upload_file, 'rb') as f:
+        f.seek(part_number * part_size)
+        data = f.read(part_size)
+
+    # Parts left over from an interrupted run are reused if they match
+    part = bucket.get_blob(f'{name}.parts/{part_number:05d}')
+    if part is not None and part.crc32c == crc32c_of(data):
+        return part
+
+    part = bucket.blob(f'{name}.parts/{part_number:05d}')
+    part.upload_from_string(data, content_type=content_type, checksum='crc32c')
+    return part
+
+
+def compose(blob:storage.Blob, parts:list) -> None:
+
+    # Compose in rounds, appending up to 31 more parts to the partial object each time
+    blob.content_type = content_type
+    blob.compose(parts[:max_compose_components])
+    for i in range(max_compose_components, len(parts), max_compose_components - 1):
+        blob.compose([blob] + parts[i:i + max_compose_components - 1])
+
 
 client = storage.Client.from_service_account_json(service_account_creds)
 bucket = client.lookup_bucket(bucket_name)
@@ -25,8 +82,30 @@ if bucket is None:
     bucket = client.create_bucket(bucket_name)
     print(f'[INFO] Bucket {bucket.name} created.')
 
+# Composite objects only have a CRC32C, so that is compared first
+local_crc32c, local_md5 = hash_file(upload_file)
+existing_blob = bucket.get_blob(name)
+if existing_blob is not None and existing_blob.crc32c == local_crc32c and existing_blob.md5_hash in (None, local_md5):
+    print(f"[INFO] {name} in GCS bucket {bucket_name} is already up to date; skipping.")
+    exit(0)
+
 blob = bucket.blob(name)
-with open(upload_file, "rb") as f:
-    blob.upload_from_file(f, content_type="text/html")
+file_size = os.path.getsize(upload_file)
+part_size = args.part_size * 1024 * 1024
+if file_size < args.parallel_threshold * 1024 * 1024:
+    with open(upload_file, "rb") as f:
+        blob.upload_from_file(f, content_type=content_type, checksum='crc32c')
+else:
+    num_parts = -(-file_size // part_size)
+    print(f'[INFO] Uploading {upload_file} in {num_parts} parts...')
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        parts = list(executor.map(upload_part, range(num_parts)))
+
+    compose(blob, parts)
+    blob.reload()
+    for part in parts:
+        part.delete()
+    if blob.crc32c != local_crc32c:
+        raise RuntimeError(f'composed object {name} does not match {upload_file}')
 
 print(f"[INFO] Uploaded {upload_file} to GCS bucket {bucket_name} as {name}.")
\ No newline at end of file
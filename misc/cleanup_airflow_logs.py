@@ -1,5 +1,10 @@
 import os
+import json
+import argparse
+import tarfile
+import tempfile
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from google.cloud import storage
 from dotenv import load_dotenv
 
@@ -11,16 +16,63 @@ service_account_creds = os.getenv("SERVICE_ACCOUNT_CREDS")
 log_path = os.getenv("AIRFLOW_LOGS_PATH")
 bucket_name = os.getenv("AIRFLOW_LOGS_BUCKET_NAME")
 
-files = []
-for root, dirs, filenames in os.walk(log_path):
-    for filename in filenames:
-        files.append(os.path.join(root, filename))
+parser = argparse.ArgumentParser()
+parser.add_argument('--archive', action='store_true', help='bundle expired logs per DAG/run directory into tar.gz archives')
+parser.add_argument('--workers', type=int, default=8, help='concurrent uploads')
+parser.add_argument('--scan_index', help='where to keep the directory scan index (default: next to the log folder)')
+parser.add_argument('--full_scan', action='store_true', help='ignore the scan index and scan every directory')
+args = parser.parse_args()
+
+
+def scan(path:str, node:dict) -> tuple:
+
+    # Walks `path` with scandir and returns its new index node and whether the whole
+    # directory can be pruned once its expired files are gone. A subtree is skipped if
+    # its mtime is unchanged and all its files were newer than the cutoff: new files
+    # can't be expired yet, and appends only make files newer
+    dir_mtime = os.stat(path).st_mtime_ns
+    if node is not None and node['mtime'] == dir_mtime and node['oldest'] is not None and node['oldest'] >= cutoff:
+        return node, False
+
+    new_node = {'mtime': dir_mtime, 'oldest': None, 'dirs': {}}
+    prunable = True
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                child_node, child_prunable = scan(entry.path, (node or {}).get('dirs', {}).get(entry.name))
+                new_node['dirs'][entry.name] = child_node
+                child_oldest = child_node['oldest']
+                prunable = prunable and child_prunable
+                if child_prunable:
+                    prunable_dirs.append(entry.path)
+            else:
+                child_oldest = entry.stat(follow_symlinks=False).st_mtime
+                if child_oldest < cutoff:
+                    files_to_cleanup.append(entry.path)
+                else:
+                    prunable = False
+            if child_oldest is not None and (new_node['oldest'] is None or child_oldest < new_node['oldest']):
+                new_node['oldest'] = child_oldest
+
+    return new_node, prunable
+
+
+cutoff = (dt.datetime.now() - dt.timedelta(days=30)).timestamp()
+scan_index_path = args.scan_index or f'{os.path.normpath(log_path)}.scan_index.json'
+scan_index = None
+if not args.full_scan and os.path.exists(scan_index_path):
+    with open(scan_index_path, 'r') as f:
+        scan_index = json.load(f)
+
+# prunable_dirs is filled children first, so it can be pruned in order after the uploads
 files_to_cleanup = []
-for file in files:
-    timestamp = os.path.getmtime(file)
-    utc_timestamp = dt.datetime.utcfromtimestamp(timestamp)
-    if utc_timestamp < (dt.datetime.now() - dt.timedelta(days=30)):
-        files_to_cleanup.append(file)
+prunable_dirs = []
+scan_index, _ = scan(log_path, scan_index)
+
+with open(f'{scan_index_path}.tmp', 'w') as f:
+    json.dump(scan_index, f)
+os.replace(f'{scan_index_path}.tmp', scan_index_path)
+
 print(f'[INFO] files to cleanup: {files_to_cleanup}')
 
 
@@ -39,7 +91,9 @@ if files_to_cleanup == []:
     print(f'[INFO] Nothing to cleanup; exiting...')
     exit(0)
 
-for local_file in files_to_cleanup:
+
+def upload_file(local_file:str) -> None:
+
     bucket_file = local_file.replace(log_path, "")
     # Create a blob object in the bucket
     blob = bucket.blob(bucket_file)
@@ -52,14 +106,72 @@ for local_file in files_to_cleanup:
     os.remove(local_file)
     print(f'[INFO] Deleted {bucket_file} from local storage')
 
-# delete empty folders
-for root, dirs, files in os.walk(log_path, topdown=False):
-    for dir_name in dirs:
-        dir_path = os.path.join(root, dir_name)
-        # Check if the directory is empty
-        if not os.listdir(dir_path):
-            # Delete the empty directory
-            os.rmdir(dir_path)
-            print(f"[INFO] Deleted empty folder: {dir_path}")
+
+def get_archive_group(local_file:str) -> str:
+
+    # Airflow logs are laid out as dag_id=.../run_id=.../task_id=.../attempt=N.log,
+    # so the first two levels under the log path are the DAG run directory
+    rel_dir = os.path.relpath(os.path.dirname(local_file), log_path)
+    if rel_dir == '.':
+        return ''
+    return os.path.join(*rel_dir.split(os.sep)[:2])
+
+
+def upload_archive(group:str, local_files:list) -> None:
+
+    # Archives are named by the run time so logs expiring later in the same directory don't overwrite them
+    bucket_file = '/'.join(filter(None, [group, f'logs__{run_time}.tar.gz']))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        archive_path = os.path.join(tmp_dir, 'logs.tar.gz')
+        with tarfile.open(archive_path, 'w:gz') as tar:
+            for local_file in local_files:
+                tar.add(local_file, arcname=os.path.relpath(local_file, os.path.join(log_path, group)))
+
+        blob = bucket.blob(bucket_file)
+        blob.upload_from_filename(archive_path, content_type='application/gzip')
+
+        # Only delete the logs once the archive is confirmed in the bucket
+        blob.reload()
+        if blob.size != os.path.getsize(archive_path):
+            raise RuntimeError(f'uploaded size of {bucket_file} does not match the local archive')
+
+    print(f"Uploaded {bucket_file} ({len(local_files)} files) to GCS")
+
+    for local_file in local_files:
+        os.remove(local_file)
+    print(f'[INFO] Deleted {len(local_files)} archived files from local storage')
+
+
+if args.archive:
+    run_time = dt.datetime.now(dt.timezone.utc).strftime('%Y%m%dT%H%M%S')
+    groups = {}
+    for local_file in files_to_cleanup:
+        groups.setdefault(get_archive_group(local_file), []).append(local_file)
+    tasks = [(upload_archive, group, local_files) for group, local_files in groups.items()]
+else:
+    tasks = [(upload_file, local_file) for local_file in files_to_cleanup]
+
+failed = 0
+with ThreadPoolExecutor(max_workers=args.workers) as executor:
+    futures = {executor.submit(*task): task[1] for task in tasks}
+    for future in as_completed(futures):
+        try:
+            future.result()
+        except Exception as e:
+            # The local files of a failed upload are kept for the next run
+            failed += 1
+            print(f'[ERROR] Failed to upload {futures[future] or log_path}: {e}')
+
+# delete folders left empty by the cleanup; folders still holding the files of a failed upload are kept
+for dir_path in prunable_dirs:
+    try:
+        os.rmdir(dir_path)
+    except OSError:
+        continue
+    print(f"[INFO] Deleted empty folder: {dir_path}")
+
+if failed:
+    print(f'[ERROR] {failed} uploads failed.')
+    exit(1)
 
 print(f'[INFO] Done!')
\ No newline at end of file
@@ -1,5 +1,8 @@
 import os
+import gzip
 import json
+import shutil
+import hashlib
 import argparse
 
 
@@ -7,24 +10,81 @@ import argparse
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--dir", type=str, help="/directory/to/dbt/project/folder")
+parser.add_argument("--output", type=str, default='/home/kevinesg/github/kevinesg.github.io/data-catalog.html', help="/path/to/combined/file.html")
+parser.add_argument("--prune", action='store_true', help="drop manifest sections the docs site doesn't use")
+parser.add_argument("--gzip", action='store_true', help="write a gzip-compressed output (<output>.gz)")
+parser.add_argument("--force", action='store_true', help="regenerate even if the input files are unchanged")
 args = parser.parse_args()
 
 os.chdir(os.path.expanduser('~'))
 dir = args.dir
-search_str = 'n=[o("manifest","manifest.json"+t),o("catalog","catalog.json"+t)]'
+search_str = b'n=[o("manifest","manifest.json"+t),o("catalog","catalog.json"+t)]'
+chunk_size = 1024 * 1024
 
-with open(dir + '/target/index.html', 'r') as f:
+# Top-level manifest keys the docs site never reads
+pruned_manifest_keys = ['disabled', 'selectors', 'group_map', 'semantic_models', 'saved_queries', 'unit_tests']
+
+input_files = [dir + '/target/index.html', dir + '/target/manifest.json', dir + '/target/catalog.json']
+output_file = args.output + '.gz' if args.gzip else args.output
+hash_file = output_file + '.sha256'
+
+
+def hash_inputs() -> str:
+
+    # The options are part of the hash since they change the output
+    sha256 = hashlib.sha256(f'prune={args.prune}'.encode())
+    for input_file in input_files:
+        with open(input_file, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def write_manifest(out) -> None:
+
+    if not args.prune:
+        # JSON is valid JavaScript, so the raw bytes can be spliced in as-is
+        with open(dir + '/target/manifest.json', 'rb') as f:
+            shutil.copyfileobj(f, out, chunk_size)
+        return
+
+    with open(dir + '/target/manifest.json', 'rb') as f:
+        json_manifest = json.load(f)
+    for key in pruned_manifest_keys:
+        json_manifest.pop(key, None)
+    for chunk in json.JSONEncoder(separators=(',', ':')).iterencode(json_manifest):
+        out.write(chunk.encode())
+
+
+inputs_hash = hash_inputs()
+if not args.force and os.path.exists(output_file) and os.path.exists(hash_file):
+    with open(hash_file, 'r') as f:
+        if f.read() == inputs_hash:
+            print("[INFO] dbt data catalog files are unchanged; skipping.")
+            exit(0)
+
+with open(dir + '/target/index.html', 'rb') as f:
     content_index = f.read()
-    
-with open(dir + '/target/manifest.json', 'r') as f:
-    json_manifest = json.loads(f.read())
-
-with open(dir + '/target/catalog.json', 'r') as f:
-    json_catalog = json.loads(f.read())
-    
-with open('/home/kevinesg/github/kevinesg.github.io/data-catalog.html', 'w') as f:
-    new_str = "n=[{label: 'manifest', data: "+json.dumps(json_manifest)+"},{label: 'catalog', data: "+json.dumps(json_catalog)+"}]"
-    new_content = content_index.replace(search_str, new_str)
-    f.write(new_content)
+
+if search_str not in content_index:
+    print(f"[ERROR] Couldn't find where to embed the manifest and catalog in {dir}/target/index.html.")
+    exit(1)
+prefix, suffix = content_index.split(search_str, 1)
+
+# Write to a temp file first so a failed run doesn't leave a half-written catalog behind
+tmp_file = output_file + '.tmp'
+with (gzip.open(tmp_file, 'wb') if args.gzip else open(tmp_file, 'wb')) as out:
+    out.write(prefix)
+    out.write(b"n=[{label: 'manifest', data: ")
+    write_manifest(out)
+    out.write(b"},{label: 'catalog', data: ")
+    with open(dir + '/target/catalog.json', 'rb') as f:
+        shutil.copyfileobj(f, out, chunk_size)
+    out.write(b"}]")
+    out.write(suffix)
+os.replace(tmp_file, output_file)
+
+with open(hash_file, 'w') as f:
+    f.write(inputs_hash)
 
 print("[INFO] Combined dbt data catalog files.")
\ No newline at end of file